@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the billing aggregation (wasabi_billing.aggregate_billing) on synthetic
+utilization payloads: the time per row should stay flat as the row count grows.
+
+    python3 bench_aggregation.py [--buckets N] [--days 10,20,40,80] [--legacy]
+
+--legacy also times the previous per-bucket rescan with strptime on every row, which
+grows with buckets x rows (use a small --buckets for it).
+"""
+
+import argparse
+import datetime
+import time
+
+from wasabi_billing import BILLING_FIELDS, aggregate_billing, day_totals
+
+
+def synthetic_rows(buckets, days):
+    """
+    :return: list of billing rows like the utilization/bucket api, one per bucket and day.
+    """
+    start = datetime.datetime(2024, 1, 1)
+    rows = []
+    for day in range(days):
+        stamp = (start + datetime.timedelta(days=day)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        for b in range(buckets):
+            row = {'Bucket': f'bucket-{b:05d}', 'StartTime': stamp}
+            for i, field in enumerate(BILLING_FIELDS):
+                row[field] = (b + 1) * (day + 1) + i
+            rows.append(row)
+    return rows
+
+
+def legacy(rows):
+    """
+    Previous fetch_metrics loop: every bucket rescans every row.
+    """
+    initial_time = datetime.datetime.strptime(rows[0]['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
+    result = {}
+    for bucket in {row['Bucket'] for row in rows}:
+        totals = dict.fromkeys(BILLING_FIELDS, 0)
+        for row in rows:
+            day = datetime.datetime.strptime(row['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
+            if row['Bucket'] == bucket and day.date() == initial_time.date():
+                for field in BILLING_FIELDS:
+                    totals[field] += row[field]
+        result[bucket] = totals
+    return result
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def single_pass(rows):
+    day, index = aggregate_billing(rows)
+    return day_totals(index, day)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--buckets', type=int, default=4000)
+    parser.add_argument('--days', default='10,20,40,80')
+    parser.add_argument('--legacy', action='store_true')
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'single pass s':>14} {'us/row':>8}" + (f" {'legacy s':>10}" if args.legacy else ''))
+    for days in (int(d) for d in args.days.split(',')):
+        rows = synthetic_rows(args.buckets, days)
+        seconds = min(timed(single_pass, rows) for _ in range(3))
+        line = f'{len(rows):>10} {seconds:>14.3f} {seconds / len(rows) * 1e6:>8.2f}'
+        if args.legacy:
+            line += f' {timed(legacy, rows):>10.3f}'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
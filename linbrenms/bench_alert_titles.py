@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark of the alert title templates of check_nutanix.py on synthetic alert
+payloads (many alerts sharing a few alert_type_uuid): the previous dict rebuild and
+str.find/str.replace per context key, against compile_title/render_title.
+
+    python3 bench_alert_titles.py [--alerts 5000] [--types 5]
+"""
+
+import argparse
+import time
+
+import check_nutanix
+
+
+def synthetic_alerts(count, types):
+    keys = [f'key_{i}' for i in range(8)]
+    alerts = []
+    for i in range(count):
+        t = i % types
+        alerts.append({
+            'id': f'alert-{i}',
+            'severity': 'kCritical',
+            'acknowledged': False,
+            'acknowledged_by_username': '',
+            'alert_type_uuid': f'A{t:04d}',
+            'alert_title': f'Type {t}: ' + ' '.join('{' + k + '}' for k in keys[:4]) + ' on {vm_name}',
+            'message': 'message',
+            'detailed_message': '',
+            'created_time_stamp_in_usecs': 1700000000000000 + i,
+            'last_occurrence_time_stamp_in_usecs': 1700000500000000 + i,
+            'impact_types': ['Availability'],
+            'classifications': ['Hardware'],
+            'context_types': keys + ['vm_name'],
+            'context_values': [f'value-{i}-{k}' for k in range(8)] + [f'vm-{i}'],
+            'resolved': False,
+            'affected_entities': [{'entity_type': 'vm', 'entity_name': f'vm-{i}', 'uuid': f'uuid-{i}'}],
+            'possible_causes': [{'cause': 'cause', 'actions': 'actions'}],
+        })
+    return alerts
+
+
+def legacy_title(x):
+    alert_title = x['alert_title']
+    objt = {}
+    for a in range(len(x['context_types'])):
+        objt.update({x['context_types'][a]: x['context_values'][a]})
+    for key in objt.keys():
+        val = '{' + key + '}'
+        if alert_title.find(val) > -1:
+            alert_title = alert_title.replace(val, str(objt[key]))
+    return alert_title
+
+
+def compiled_title(x):
+    objt = dict(zip(x['context_types'], x['context_values']))
+    return check_nutanix.render_title(check_nutanix.compile_title(x['alert_type_uuid'], x['alert_title']), objt)
+
+
+def best(func, *args, repeat=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--alerts', type=int, default=5000)
+    parser.add_argument('--types', type=int, default=5)
+    args = parser.parse_args()
+
+    alerts = synthetic_alerts(args.alerts, args.types)
+    assert all(legacy_title(x) == compiled_title(x) for x in alerts)
+
+    results = [
+        ('title legacy', best(lambda: [legacy_title(x) for x in alerts])),
+        ('title compiled', best(lambda: [compiled_title(x) for x in alerts])),
+    ]
+
+    print(f'{args.alerts} alerts, {args.types} alert types')
+    for name, seconds in results:
+        print(f'{name:<16} {seconds * 1000:>9.1f} ms {seconds / args.alerts * 1e6:>8.2f} us/alert')
+
+
+if __name__ == '__main__':
+    main()
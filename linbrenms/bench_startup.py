@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Startup benchmark of the Nagios checks: wall clock per invocation and import-time
+profile (python -X importtime), against local stand-ins so no Prism or Wasabi is needed.
+
+Stand-ins:
+  - check_nutanix.py --socket: a Unix socket answering like the --daemon collector.
+  - check_wasabi.py / check_wasabi_bucket.py: a fresh billing cache file (--cache) with
+    --buckets synthetic buckets, written with wasabi_billing.write_cache.
+  - --prism IP also times the direct mode against that cluster (or a local stand-in
+    listening on IP:9440).
+
+--tree DIR runs the checks of another checkout with the same stand-ins, e.g. to compare
+with the revision before the fast start changes (git worktree add /tmp/old <rev>, then
+--tree /tmp/old/linbrenms). Cases that revision does not support fail fast and are skipped
+from the comparison by hand.
+
+Exits 1 when a case imports one of the --forbid modules, or its median is above --max-ms,
+so it can run in CI to catch startup regressions.
+
+    python3 bench_startup.py [--runs 20] [--buckets 4000] [--max-ms 0] [--top 8]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import wasabi_billing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FORBID = 'requests,urllib3,boto3,email,asyncio'
+
+
+def socket_stand_in(path):
+    """
+    Answers every query like run_daemon does for a cluster without alarms.
+    """
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(64)
+
+    def serve():
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                query = json.loads(conn.makefile('rb').readline())
+                results = [[0, f"NO {atype} ALARM ON NUTANIX CLUSTER {query['ip']}"] for atype in query['atypes']]
+                conn.sendall((json.dumps({'age': 1.0, 'error': None, 'results': results}) + '\n').encode())
+
+    threading.Thread(target=serve, daemon=True).start()
+
+
+def billing_stand_in(path, buckets):
+    usage = {}
+    for i in range(buckets):
+        usage[f'bucket-{i:05d}'] = dict(zip(wasabi_billing.BILLING_FIELDS, (i * 2**30, i, i * 10, i)))
+    wasabi_billing.write_cache(path, datetime.date.today(), usage)
+
+
+def wall_clock(command, runs, cwd):
+    """
+    :return: list of milliseconds per invocation.
+    """
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def import_profile(command, cwd):
+    """
+    :return: tuple (set of imported module names, list of (cumulative us, top level module)).
+    """
+    stderr = subprocess.run([command[0], '-X', 'importtime'] + command[1:], cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True).stderr
+    modules = set()
+    top = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        if not name.startswith('  ', 1):  # nested imports are indented after the separator space
+            top.append((int(cumulative), name.strip()))
+    return modules, sorted(top, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--buckets', type=int, default=4000)
+    parser.add_argument('--top', type=int, default=8, help='slowest top level imports shown per case')
+    parser.add_argument('--max-ms', type=float, default=0, help='fail when a median is above this (0 = no limit)')
+    parser.add_argument('--forbid', default=FORBID, help='modules the fast paths must not import')
+    parser.add_argument('--tree', default=HERE, help='directory with the check scripts to time')
+    parser.add_argument('--prism', help='also time check_nutanix.py direct mode against this ip')
+    parser.add_argument('--username', default='admin')
+    parser.add_argument('--password', default='')
+    args = parser.parse_args()
+
+    python = sys.executable
+    forbid = {m for m in args.forbid.split(',') if m}
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        sock = os.path.join(tmp, 'nutanix.sock')
+        cache = os.path.join(tmp, 'billing.cache')
+        socket_stand_in(sock)
+        billing_stand_in(cache, args.buckets)
+
+        cases = [
+            ('python -c pass', [python, '-c', 'pass'], False),
+            ('check_nutanix --socket', [python, 'check_nutanix.py', '--socket', sock, '--ip', '10.0.0.1',
+                                        '--atype', 'CRITICAL,WARNING'], True),
+            ('check_wasabi --cache', [python, 'check_wasabi.py', '--cache', cache, '--max-age', '86400'], True),
+            ('check_wasabi_bucket --cache', [python, 'check_wasabi_bucket.py', '--cache', cache, '--max-age', '86400',
+                                             '--buckets', 'bucket-00001,bucket-00002', '--contratado', '100'], True),
+        ]
+        if args.prism:
+            cases.append(('check_nutanix direct', [python, 'check_nutanix.py', '--ip', args.prism, '--username',
+                                                   args.username, '--password', args.password], False))
+
+        for name, command, fast_path in cases:
+            times = wall_clock(command, args.runs, args.tree)
+            median = statistics.median(times)
+            modules, top = import_profile(command, args.tree)
+            print(f'{name:<28} median {median:7.1f} ms  min {min(times):7.1f} ms  '
+                  f'max {max(times):7.1f} ms  {len(modules)} modules imported')
+            for cumulative, module in top[:args.top]:
+                print(f'    {cumulative / 1000:7.1f} ms  {module}')
+            if fast_path:
+                unexpected = sorted({m.split('.')[0] for m in modules} & forbid)
+                if unexpected:
+                    print(f'    FAIL: imports {", ".join(unexpected)}')
+                    failed = True
+                if args.max_ms and median > args.max_ms:
+                    print(f'    FAIL: median above {args.max_ms} ms')
+                    failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Peak RSS of the streamed billing ingestion (iter_json_array + aggregate_billing) against
+large local fixtures. Every size has the same buckets and days, only more rows per
+(bucket, day), so the aggregated index is the same and peak memory must stay flat.
+Each size is measured in a fresh process; exits 1 when the peak grows more than --slack MB.
+
+    python3 bench_streaming_rss.py [--sizes 20000,200000,1000000] [--slack 10] [--dir /tmp]
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+from wasabi_billing import BILLING_FIELDS, CHUNK_SIZE, aggregate_billing, iter_json_array
+
+BUCKETS = 500
+DAYS = 10
+
+
+def write_fixture(path, rows):
+    """
+    Utilization payload of rows rows spread over BUCKETS buckets and DAYS days, written
+    in pieces so the fixture itself never sits in memory.
+    """
+    with open(path, 'w') as f:
+        f.write('[')
+        for i in range(rows):
+            row = {'Bucket': f'bucket-{i % BUCKETS:05d}',
+                   'StartTime': f'2024-01-{1 + (i // BUCKETS) % DAYS:02d}T{i % 24:02d}:00:00Z'}
+            row.update((field, i) for field in BILLING_FIELDS)
+            f.write((',' if i else '') + json.dumps(row))
+        f.write(']')
+
+
+def ingest(path):
+    """
+    Child process: stream the fixture, print the peak RSS in MB.
+    """
+    def chunks():
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    _, index = aggregate_billing(iter_json_array(chunks()))
+    assert len(index) == BUCKETS * DAYS
+    print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)  # ru_maxrss is in KiB on Linux
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        ingest(sys.argv[2])
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='20000,200000,1000000')
+    parser.add_argument('--slack', type=float, default=10)
+    parser.add_argument('--dir', default=None)
+    args = parser.parse_args()
+
+    peaks = []
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        for rows in (int(n) for n in args.sizes.split(',')):
+            path = os.path.join(tmp, f'billing_{rows}.json')
+            write_fixture(path, rows)
+            size = os.path.getsize(path) / 2**20
+            out = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', path],
+                                 check=True, capture_output=True, text=True).stdout
+            peaks.append(float(out))
+            os.remove(path)
+            print(f'{rows:>10} rows {size:>8.1f} MB payload  peak RSS {peaks[-1]:>7.1f} MB')
+
+    growth = max(peaks) - min(peaks)
+    print(f'peak RSS growth {growth:.1f} MB (allowed {args.slack} MB)')
+    sys.exit(0 if growth <= args.slack else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,33 +7,331 @@
 # David Lira, dlira96@gmail.com                                              #
 ##############################################################################
 
+# requests, urllib3, asyncio, hmac and concurrent.futures are imported by the modes that
+# use them (see prism_http), so a --socket check starts with the stdlib basics only.
 import argparse
-import getpass
-import requests
-import urllib3
 import datetime
+import json
 import os
+import re
+import shutil
+import socket
 import sys
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import time
 
 VERSION = 'v1.4'
 TIMEOUT = 30
-print('NUTANIX ALARM CLUSTER HEALTH (NTACH)',VERSION)
-print('Author: David Lira, dlirachile2@gmail.com)')
-print('Tiemout:',TIMEOUT,'\n')
 
 ip=''
 username='librenms'
 password=''
 atype='CRITICAL'
 status='n'
+CONCURRENCY = 20
+PAGE_SIZE = 500
+FULL_SYNC = 3600
+INTERVAL = 60
+MAX_AGE = 300
+WEBHOOK_MIN_INTERVAL = 30
+READ_TIMEOUT = 10
+
+def banner():
+        print('NUTANIX ALARM CLUSTER HEALTH (NTACH)',VERSION)
+        print('Author: David Lira, dlirachile2@gmail.com)')
+        print('Tiemout:',TIMEOUT,'\n')
+
+def prism_http():
+        """
+        Imports requests for the modes that call Prism Element and silences the
+        self-signed certificate warnings.
+        :return: the requests module.
+        """
+        import requests
+        import urllib3
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        return requests
+
+def pooled_session(clusters):
+        """
+        One session for many clusters: one keep-alive TLS connection per cluster.
+        """
+        requests = prism_http()
+        from requests.adapters import HTTPAdapter
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=max(len(clusters), 1), pool_maxsize=1))
+        return session
+
+def nagios_state(atype, state_ok, ip):
+        """
+        Nagios exit code and status line for the number of alarms found.
+        :return: tuple (code, info) or None if atype is not CRITICAL/WARNING.
+        """
+        if atype == 'CRITICAL':
+                if state_ok == 0:
+                        return 0, "NO CRITICAL ALARM ON NUTANIX CLUSTER " + ip
+                return 2, "YOU HAVE " + str(state_ok) + " CRITICAL ON NUTANIX CLUSTER " + ip
+        if atype == 'WARNING':
+                if state_ok == 0:
+                        return 0, "NO WARNING ALARM ON NUTANIX CLUSTER " + ip
+                return 1, "YOU HAVE " + str(state_ok) + " WARNING ON NUTANIX CLUSTER " + ip
+        return None
+
+SEVERITIES = {'kCritical': 'CRITICAL', 'kWarning': 'WARNING'}
+
+def alerts_url(base_url, x, atypes, start_time=None, detailed=True):
+        """
+        A single alarm type keeps the server side severity filter, several alarm
+        types are fetched together in one unfiltered call and split locally.
+        start_time (usecs) limits the history to alarms created after it.
+        detailed=False leaves out the causes and detailed info, enough to list ids.
+        """
+        url = base_url + f'/PrismGateway/services/rest/v2.0/alerts/?resolved={x}'
+        if detailed:
+                url += '&get_causes=true&detailed_info=true'
+        if len(atypes) == 1:
+                url += f'&severity={atypes[0]}'
+        if start_time:
+                url += f'&start_time_in_usecs={start_time}'
+        return url
+
+def iter_alerts(session, url, auth, page_size=PAGE_SIZE):
+        """
+        Walks the v2 alerts API page by page (page/count) and yields one alarm at a
+        time, so only a single page is held in memory whatever the history size.
+        The walk ends on metadata.total_entities (Prism may return fewer than count
+        entities per page) or on an empty page.
+        """
+        page = 1
+        seen = 0
+        while True:
+                r = session.get(url + f'&page={page}&count={page_size}', auth=auth, verify=False, timeout=TIMEOUT)
+                r.raise_for_status()
+                body = r.json()
+                entities = body['entities']
+                yield from entities
+                seen += len(entities)
+                total = (body.get('metadata') or {}).get('total_entities')
+                if not entities or (total is not None and seen >= total):
+                        return
+                page += 1
+
+def alert_atype(x, atypes):
+        """
+        Alarm type (CRITICAL/WARNING) an alarm belongs to, or None if it was not requested.
+        """
+        if len(atypes) == 1:
+                return atypes[0]
+        atype = SEVERITIES.get(x['severity'])
+        return atype if atype in atypes else None
+
+def load_state(path):
+        """
+        Alert state saved by the previous run, {} if there is none yet.
+        """
+        try:
+                with open(path) as f:
+                        return json.load(f)
+        except (OSError, ValueError):
+                return {}
+
+def save_state(path, state):
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+                json.dump(state, f)
+        os.replace(tmp, path)
+
+def cluster_state(state, ip, x, atypes, full_sync, start_time=None):
+        """
+        Cached alarms of one cluster and query (resolved flag + alarm types), keyed by alert UUID.
+        While the last full sync is younger than full_sync seconds only alarms created after
+        the stored watermark are requested (a delta, see reconcile_state); otherwise the cache
+        is rebuilt from a full fetch.
+        :return: tuple (entry, alarms known before this run, start_time to query, delta or not).
+        """
+        key = ip + '|' + x + '|' + ','.join(atypes)
+        entry = state.setdefault(key, {'watermark': 0, 'full_sync': 0, 'alerts': {}, 'open': {}})
+        known = entry['alerts']
+        if entry['watermark'] and time.time() - entry['full_sync'] < full_sync:
+                return entry, known, max(entry['watermark'], start_time or 0), True
+        entry['alerts'] = {}
+        entry['watermark'] = 0
+        entry['full_sync'] = time.time()
+        return entry, known, start_time, False
 
-def alerts(ip, username, password, atype, status):
-        state_ok = 0
+def reconcile_state(session, entry, base_url, x, atypes, start_time, query_start, delta, auth):
+        """
+        The alerts API only filters on creation time, so a delta alone would miss later
+        changes to older alarms. Every run lists the unresolved alarms without causes and
+        detailed info (the open alarms only, never the resolved history) and compares them
+        with the previous run:
+          - an alarm no longer open was resolved or deleted: it is dropped from the cache
+            (--resolved n), or the delta goes back to its creation to fetch it (--resolved y).
+          - an open alarm repeated or acknowledged since (--resolved n): the delta goes back
+            to its creation to fetch it again.
+        :return: start_time to query.
+        """
+        current = {}
+        for alert in iter_alerts(session, alerts_url(base_url, 'false', atypes, start_time, detailed=False), auth):
+                current[alert['id']] = [alert['created_time_stamp_in_usecs'],
+                                        alert['last_occurrence_time_stamp_in_usecs'],
+                                        alert['acknowledged']]
+        previous = entry.get('open', {})
+        entry['open'] = current
+        if not delta:
+                return query_start
+        for alert_id, seen in previous.items():
+                now = current.get(alert_id)
+                if now is None:  # resolved or deleted since the last run
+                        if x == 'false':
+                                entry['alerts'].pop(alert_id, None)
+                        else:
+                                query_start = min(query_start, seen[0])
+                elif x == 'false' and now != seen:  # repeated or acknowledged
+                        query_start = min(query_start, seen[0])
+        return query_start
+
+def merge_alert(entry, known, x, atype):
+        """
+        Stores an alarm in the cluster state.
+        :return: 'new', 'changed' or None when it is the same as in the last run.
+        """
+        cached = {'atype': atype,
+                  'resolved': x['resolved'],
+                  'acknowledged': x['acknowledged'],
+                  'last_occurrence_time_stamp_in_usecs': x['last_occurrence_time_stamp_in_usecs']}
+        previous = known.get(x['id'])
+        entry['alerts'][x['id']] = cached
+        entry['watermark'] = max(entry['watermark'], x['created_time_stamp_in_usecs'])
+        if previous is None:
+                return 'new'
+        if previous != cached:
+                return 'changed'
+        return None
+
+def cached_counts(entry, atypes, status):
+        counts = dict.fromkeys(atypes, 0)
+        for cached in entry['alerts'].values():
+                if cached['atype'] in counts and counts_against(cached, status):
+                        counts[cached['atype']] += 1
+        return counts
+
+PLACEHOLDER = re.compile(r'\{([^{}]*)\}')
+title_templates = {}
+
+def compile_title(alert_type_uuid, alert_title):
+        """
+        Splits an alert title into literal text and {placeholder} names once per
+        alert type and title: even positions are text, odd positions are placeholders.
+        """
+        key = (alert_type_uuid, alert_title)
+        template = title_templates.get(key)
+        if template is None:
+                template = title_templates[key] = PLACEHOLDER.split(alert_title)
+        return template
+
+def render_title(template, objt):
+        """
+        Fills a compiled title with the alert context, unknown placeholders are kept as they are.
+        """
+        parts = template[:]
+        for i in range(1, len(parts), 2):
+                key = parts[i]
+                parts[i] = str(objt[key]) if key in objt else '{' + key + '}'
+        return ''.join(parts)
+
+def report_alert(x, atype, status, ip, cluster_name, base_url, state_ok):
+        """
+        Prints one alarm and returns the alarm counter updated for the check.
+        """
+        severity = x['severity']
+        acknowledged = x['acknowledged']
+        alert_type_uuid = x['alert_type_uuid']
+        created_time_stamp_in_usecs = x['created_time_stamp_in_usecs']
+        created_time_stamp_in_usecs_datetime = datetime.datetime.fromtimestamp(created_time_stamp_in_usecs / 1000000 )
+        last_occurrence_time_stamp_in_usecs = x['last_occurrence_time_stamp_in_usecs']
+        last_occurrence_time_stamp_in_usecs_datetime = datetime.datetime.fromtimestamp(last_occurrence_time_stamp_in_usecs / 1000000 )
+        impact_types = x['impact_types'][0]
+        classifications = x['classifications'][0]
+        acknowledged_by_username = x['acknowledged_by_username']
+        alert_title = x['alert_title']
+        message = x['message']
+        detailed_message = x['detailed_message']
+        name_ent = x['context_values']
+        nproblem=name_ent[0]
+        resolved = x['resolved']
+        for y in x['affected_entities']:
+                entity_type = y['entity_type']
+                entity_name = y['entity_name']
+                uuid = y['uuid']
+        for y in x['possible_causes']:
+                causes = y['cause']
+                actions= y['actions']
+        objt = dict(zip(x['context_types'], x['context_values'])) if 'context_types' in x else {}
+        alert_title = render_title(compile_title(alert_type_uuid, alert_title), objt)
+        ###PRINT INFO
+        if severity == 'kWarning':
+                print('-Severity:','\033[93m' + severity + '\x1b[0m')
+        elif severity == 'kCritial':
+                print('-Severity:','\033[91m' + severity + '\x1b[0m')
+        print('-Name Cluster:',cluster_name)
+        print('-Alert Title:', alert_title)
+        if nproblem == '{}':
+                print('-Posible name problem: ', '-')
+        else:
+                print('-Posible name problem: ', nproblem)
+        #print('-Detailed Messages: ', detailed_message)
+        print('-Affected entities: ', entity_type)
+        print('-classifications: ', classifications)
+        print('-'+entity_type+' name: ', entity_name)
+        print('-'+entity_type+' UUID: ', uuid)
+        print('-Posbile Cause:', causes)
+        print('-Posbile Action:', actions)
+        print('-Alert Type UUID:', alert_type_uuid)
+        print('-Acknowledged: ', acknowledged)
+        print('-Acknowledged by Username: ', acknowledged_by_username)
+        print('-resolved:', resolved)
+        print('-Creation alarm: ', created_time_stamp_in_usecs_datetime)
+        print('-Last time the alarm was repeated: ', last_occurrence_time_stamp_in_usecs_datetime)
+        print('-Impact Type: ', impact_types)
+        print('-Alarm Counter:',state_ok)
+        print('-Prism Element URL:',base_url)
+        print("-Detailed info: ",name_ent )
+        print('-----------------------------------------------------------------')
+        if status == 'y':
+                if atype == 'CRITICAL'  :
+                        state_ok = state_ok + 1
+                elif atype == 'WARNING' :
+                        state_ok = state_ok + 1
+                else: #####NAGIOS CODE FOR UNKNOWN
+                        #print(atype)
+                        print("UNKNOWN ALARM NUTANIX CLUSTER " + ip)
+                        sys.exit(3)
+        elif status == 'n':
+                if atype == 'CRITICAL' and resolved == False :
+                        state_ok = state_ok + 1
+                elif atype == 'WARNING' and resolved == False:
+                        state_ok = state_ok + 1
+                else: #####NAGIOS CODE FOR UNKNOWN
+                        print(atype)
+                        print(resolved)
+                        print("UNKNOWN ALARM NUTANIX CLUSTER " + ip)
+                        sys.exit(3)
+        else:
+                print('Insert a valid --status option (y/n)')
+        return state_ok
+
+def alerts(ip, username, password, atype, status, days=None, state_path=None, full_sync=FULL_SYNC):
+        atypes = [a.strip().upper() for a in atype.split(',') if a.strip()]
         base_url = "https://"+ip+":9440"
+        start_time = int((time.time() - days * 86400) * 1000000) if days else None
+        if not atypes or any(a not in ('CRITICAL', 'WARNING') for a in atypes):
+                #####NAGIOS CODE FOR UNKNOWN
+                print('No correct alarm selected , type "WARNING OR CRITICAL in --atype')
+                sys.exit(3)
+        requests = prism_http()
+        session = requests.Session()  # one TLS connection for the cluster info and every alerts page
         try:
-                pe_cluster_info = requests.get(base_url + '/PrismGateway/services/rest/v2.0/cluster/', auth=(username, password), verify=False, timeout=TIMEOUT)
+                pe_cluster_info = session.get(base_url + '/PrismGateway/services/rest/v2.0/cluster/', auth=(username, password), verify=False, timeout=TIMEOUT)
                 if pe_cluster_info.status_code == requests.codes.ok:
                         out_json = pe_cluster_info.json()
                         raw_cluster =  out_json
@@ -47,143 +345,411 @@ def alerts(ip, username, password, atype, status):
                 else:
                         print('Insert a valid info on --status (y/n)')
                         x = 'false'
-                if atype == 'CRITICAL':
-                        r = requests.get(base_url + f'/PrismGateway/services/rest/v2.0/alerts/?resolved={x}&severity=CRITICAL&get_causes=true&detailed_info=true',
-                         auth=(username, password),
-                         verify=False,
-                         timeout=TIMEOUT)
-
-                elif atype == 'WARNING':
-                        r = requests.get(base_url + f'/PrismGateway/services/rest/v2.0/alerts/?resolved={x}&severity=WARNING&get_causes=true&detailed_info=true',
-                         auth=(username, password),
-                         verify=False,
-                         timeout=TIMEOUT)
-                else:
-                        print('No correct alarm selected , type "WARNING OR CRITICAL in --atype')
-                if r.status_code == requests.codes.ok:
-                        entities = r.json()['entities']
-                        state_ok=0
-                        for x in entities:
-                                severity = x['severity']
-                                acknowledged = x['acknowledged']
-                                alert_type_uuid = x['alert_type_uuid']
-                                created_time_stamp_in_usecs = x['created_time_stamp_in_usecs']
-                                created_time_stamp_in_usecs_datetime = datetime.datetime.fromtimestamp(created_time_stamp_in_usecs / 1000000 )
-                                last_occurrence_time_stamp_in_usecs = x['last_occurrence_time_stamp_in_usecs']
-                                last_occurrence_time_stamp_in_usecs_datetime = datetime.datetime.fromtimestamp(last_occurrence_time_stamp_in_usecs / 1000000 )
-                                impact_types = x['impact_types'][0]
-                                classifications = x['classifications'][0]
-                                acknowledged_by_username = x['acknowledged_by_username']
-                                alert_title = x['alert_title']
-                                message = x['message']
-                                detailed_message = x['detailed_message']
-                                name_ent = x['context_values']
-                                nproblem=name_ent[0]
-                                resolved = x['resolved']
-                                for y in x['affected_entities']:
-                                        entity_type = y['entity_type']
-                                        entity_name = y['entity_name']
-                                        uuid = y['uuid']
-                                for y in x['possible_causes']:
-                                        causes = y['cause']
-                                        actions= y['actions']
-                                if 'context_types' in x.keys():
-                                        name_objetct = []
-                                        objt = {}
-                                        for a in range(len(x['context_types'])):
-                                                objt.update({x['context_types'][a]:x['context_values'][a]})
-                                                name_objetct.append(a)
-                                if objt:
-                                        for key in objt.keys():
-                                                val = '{'+key+'}'
-                                                if alert_title.find(val) > -1:
-                                                        alert_title = alert_title.replace(val,str(objt[key]))
-                                ###PRINT INFO
-                                if severity == 'kWarning':
-                                        print('-Severity:','\033[93m' + severity + '\x1b[0m')
-                                elif severity == 'kCritial':
-                                        print('-Severity:','\033[91m' + severity + '\x1b[0m')
-                                print('-Name Cluster:',cluster_name)
-                                print('-Alert Title:', alert_title)
-                                if nproblem == '{}':
-                                        print('-Posible name problem: ', '-')
-                                else:
-                                        print('-Posible name problem: ', nproblem)
-                                #print('-Detailed Messages: ', detailed_message)
-                                print('-Affected entities: ', entity_type)
-                                print('-classifications: ', classifications)
-                                print('-'+entity_type+' name: ', entity_name)
-                                print('-'+entity_type+' UUID: ', uuid)
-                                print('-Posbile Cause:', causes)
-                                print('-Posbile Action:', actions)
-                                print('-Alert Type UUID:', alert_type_uuid)
-                                print('-Acknowledged: ', acknowledged)
-                                print('-Acknowledged by Username: ', acknowledged_by_username)
-                                print('-resolved:', resolved)
-                                print('-Creation alarm: ', created_time_stamp_in_usecs_datetime)
-                                print('-Last time the alarm was repeated: ', last_occurrence_time_stamp_in_usecs_datetime)
-                                print('-Impact Type: ', impact_types)
-                                print('-Alarm Counter:',state_ok)
-                                print('-Prism Element URL:',base_url)
-                                print("-Detailed info: ",name_ent )
-                                print('-----------------------------------------------------------------')
-                                if status == 'y':
-                                        if atype == 'CRITICAL'  :
-                                                state_ok = state_ok + 1
-                                        elif atype == 'WARNING' :
-                                                state_ok = state_ok + 1
-                                        else: #####NAGIOS CODE FOR UNKNOWN
-                                                #print(atype)
-                                                print("UNKNOWN ALARM NUTANIX CLUSTER " + ip)
-                                                sys.exit(3)
-                                elif status == 'n':
-                                        if atype == 'CRITICAL' and resolved == False :
-                                                state_ok = state_ok + 1
-                                        elif atype == 'WARNING' and resolved == False:
-                                                state_ok = state_ok + 1
-                                        else: #####NAGIOS CODE FOR UNKNOWN
-                                                print(atype)
-                                                print(resolved)
-                                                print("UNKNOWN ALARM NUTANIX CLUSTER " + ip)
-                                                sys.exit(3)
-                                else:
-                                        print('Insert a valid --status option (y/n)')
+                state = load_state(state_path) if state_path else None
+                query_start = start_time
+                if state is not None:
+                        entry, known, query_start, delta = cluster_state(state, ip, x, atypes, full_sync, start_time)
+                        query_start = reconcile_state(session, entry, base_url, x, atypes, start_time, query_start, delta, (username, password))
+                counts = dict.fromkeys(atypes, 0)
+                new = dict.fromkeys(atypes, 0)
+                for alert in iter_alerts(session, alerts_url(base_url, x, atypes, query_start), (username, password)):
+                        a = alert_atype(alert, atypes)
+                        if not a:
+                                continue
+                        if state is not None:
+                                # only alarms that are new or changed since the last run are printed
+                                change = merge_alert(entry, known, alert, a)
+                                if change is None:
+                                        continue
+                                if change == 'new':
+                                        new[a] += 1
+                        counts[a] = report_alert(alert, a, status, ip, cluster_name, base_url, counts[a])
+                if state is not None:
+                        counts = cached_counts(entry, atypes, status)
+                        save_state(state_path, state)
                 #####NAGIOS CODE FOR CRITICAL AND WARNING
-                if state_ok == 0 and atype =='CRITICAL':
-                        info = "NO CRITICAL ALARM ON NUTANIX CLUSTER " + ip
-                        print(info)
-                        sys.exit(0)
-                elif not state_ok == 0 and atype =='CRITICAL':
-                        info = "YOU HAVE " + str(state_ok) + " CRITICAL ON NUTANIX CLUSTER " + ip
-                        print(info)
-                        sys.exit(2)
-                if state_ok == 0 and atype == 'WARNING':
-                        info = "NO WARNING ALARM ON NUTANIX CLUSTER " + ip
+                results = [nagios_state(a, counts[a], ip) for a in atypes]
+                for a, (code, info) in zip(atypes, results):
+                        if state is not None:
+                                info += " (" + str(new[a]) + " NEW SINCE LAST RUN)"
                         print(info)
-                        sys.exit(0)
-                elif not state_ok == 0 and atype =='WARNING':
-                        info = "YOU HAVE " + str(state_ok) + " WARNING ON NUTANIX CLUSTER " + ip
-                        print(info)
-                        sys.exit(1)
+                sys.exit(max(code for code, info in results))
         except Exception as e:
-                print(f"Error: {e}")
+                #####NAGIOS CODE FOR UNKNOWN
+                print("UNKNOWN ALARM NUTANIX CLUSTER " + ip + f" (Error: {e})")
+                sys.exit(3)
+
+def read_inventory(path):
+        """
+        Cluster inventory, one cluster per line: ip[,host[,username[,password]]]
+        Empty lines and lines starting with # are ignored. Missing fields fall back to
+        the ip and to the --username/--password given on the command line.
+        """
+        clusters = []
+        with open(path) as f:
+                for line in f:
+                        line = line.strip()
+                        if not line or line.startswith('#'):
+                                continue
+                        parts = [p.strip() for p in line.split(',')]
+                        clusters.append({
+                                'ip': parts[0],
+                                'host': parts[1] if len(parts) > 1 and parts[1] else parts[0],
+                                'username': parts[2] if len(parts) > 2 and parts[2] else None,
+                                'password': parts[3] if len(parts) > 3 and parts[3] else None,
+                        })
+        return clusters
+
+def counts_against(x, status):
+        """
+        Whether an alarm counts against the check, same rule as alerts():
+        every alarm when listing resolved ones (y), only unresolved ones otherwise.
+        """
+        return status == 'y' or x['resolved'] == False
+
+def fetch_cluster_alerts(session, ip, username, password, atypes, status, start_time=None, state=None, full_sync=FULL_SYNC):
+        """
+        Blocking Prism Element calls for one cluster, all on the same keep-alive session:
+        the cluster info plus the paged alerts calls for every requested alarm type.
+        With a state dict only the delta since the last run is requested, after comparing the
+        open alarms with the last run (see cluster_state and reconcile_state).
+        :return: tuple (dict of atype -> number of alarms, dict of atype -> new alarms or None).
+        """
+        base_url = "https://"+ip+":9440"
+        x = 'true' if status == 'y' else 'false'
+        pe_cluster_info = session.get(base_url + '/PrismGateway/services/rest/v2.0/cluster/', auth=(username, password), verify=False, timeout=TIMEOUT)
+        pe_cluster_info.raise_for_status()
+        query_start = start_time
+        if state is not None:
+                entry, known, query_start, delta = cluster_state(state, ip, x, atypes, full_sync, start_time)
+                query_start = reconcile_state(session, entry, base_url, x, atypes, start_time, query_start, delta, (username, password))
+        counts = dict.fromkeys(atypes, 0)
+        new = dict.fromkeys(atypes, 0)
+        for alert in iter_alerts(session, alerts_url(base_url, x, atypes, query_start), (username, password)):
+                a = alert_atype(alert, atypes)
+                if not a:
+                        continue
+                if state is not None:
+                        if merge_alert(entry, known, alert, a) == 'new':
+                                new[a] += 1
+                elif counts_against(alert, status):
+                        counts[a] += 1
+        if state is None:
+                return counts, None
+        return cached_counts(entry, atypes, status), new
+
+async def poll_cluster(loop, executor, semaphore, session, cluster, username, password, atypes, status, start_time, state, full_sync):
+        """
+        :return: list of (host, atype, code, info) for one cluster.
+        """
+        async with semaphore:
+                try:
+                        counts, new = await loop.run_in_executor(
+                                executor, fetch_cluster_alerts, session, cluster['ip'],
+                                cluster['username'] or username, cluster['password'] or password, atypes, status,
+                                start_time, state, full_sync)
+                except Exception as e:
+                        return [(cluster['host'], atype, 3, "UNKNOWN ALARM NUTANIX CLUSTER " + cluster['ip'] + f" ({e})") for atype in atypes]
+        results = []
+        for atype in atypes:
+                code, info = nagios_state(atype, counts[atype], cluster['ip'])
+                if new is not None:
+                        info += " (" + str(new[atype]) + " NEW SINCE LAST RUN)"
+                results.append((cluster['host'], atype, code, info))
+        return results
+
+async def poll_inventory(clusters, username, password, atypes, status, concurrency, days=None, state=None, full_sync=FULL_SYNC):
+        """
+        Polls every cluster concurrently, at most `concurrency` at a time, sharing one
+        pooled session so each cluster keeps a single TLS connection for all its calls.
+        Each cluster only touches its own key of the state dict.
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        session = pooled_session(clusters)
+        semaphore = asyncio.Semaphore(concurrency)
+        start_time = int((time.time() - days * 86400) * 1000000) if days else None
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                per_cluster = await asyncio.gather(*(
+                        poll_cluster(loop, executor, semaphore, session, cluster, username, password, atypes, status, start_time, state, full_sync)
+                        for cluster in clusters))
+        session.close()
+        return [result for results in per_cluster for result in results]
+
+def passive_results(results, service):
+        """
+        Nagios/Icinga external command lines (PROCESS_SERVICE_CHECK_RESULT), usable as
+        a check-result file or written to the command pipe.
+        """
+        now = int(time.time())
+        return [f"[{now}] PROCESS_SERVICE_CHECK_RESULT;{host};{service} {atype};{code};" + info.replace('\n', ' ')
+                for host, atype, code, info in results]
+
+async def watch_cluster(loop, executor, semaphore, session, cluster, username, password, atypes, status, state, full_sync, interval, cache, wake):
+        """
+        Daemon side: polls one cluster forever, every `interval` seconds or as soon as a
+        webhook sets `wake`, and keeps its last counts in cache[ip]. A failed poll keeps
+        the previous counts (and their time) and records the error.
+        Polls start at least WEBHOOK_MIN_INTERVAL seconds apart, webhooks received in
+        between are served by the next poll.
+        """
+        import asyncio
+        ip = cluster['ip']
+        last_poll = None
+        while True:
+                if last_poll is not None:
+                        delay = last_poll + WEBHOOK_MIN_INTERVAL - time.monotonic()
+                        if delay > 0:
+                                await asyncio.sleep(delay)
+                wake.clear()
+                last_poll = time.monotonic()
+                try:
+                        async with semaphore:
+                                counts, new = await loop.run_in_executor(
+                                        executor, fetch_cluster_alerts, session, ip,
+                                        cluster['username'] or username, cluster['password'] or password, atypes, status,
+                                        None, state, full_sync)
+                        cache[ip] = {'time': time.time(), 'counts': counts, 'error': None}
+                except Exception as e:
+                        cache.setdefault(ip, {'time': 0, 'counts': None, 'error': None})['error'] = str(e)
+                try:
+                        await asyncio.wait_for(wake.wait(), interval)
+                except asyncio.TimeoutError:
+                        pass
+
+async def serve_query(reader, writer, cache, atypes, names):
+        """
+        One JSON line in ({"ip": ..., "atypes": [...]}), one JSON line out with the
+        Nagios results for the cached counts and their age in seconds.
+        The cluster can be given by ip or by its inventory host name (names maps host -> ip).
+        """
+        import asyncio
+        try:
+                query = json.loads(await asyncio.wait_for(reader.readline(), READ_TIMEOUT))
+                ip = names.get(query['ip'], query['ip'])
+                wanted = query['atypes']
+                entry = cache.get(ip)
+                if any(a not in atypes for a in wanted):
+                        reply = {'error': 'daemon does not poll ' + ','.join(wanted)}
+                elif entry is None:
+                        reply = {'error': 'cluster not in the daemon inventory or not polled yet'}
+                elif entry['counts'] is None:
+                        reply = {'error': entry['error']}
+                else:
+                        reply = {'age': time.time() - entry['time'],
+                                 'error': entry['error'],
+                                 'results': [nagios_state(a, entry['counts'][a], ip) for a in wanted]}
+        except (ValueError, KeyError, TypeError) as e:
+                reply = {'error': f'bad query: {e}'}
+        except asyncio.TimeoutError:
+                reply = {'error': 'timed out waiting for the query'}
+        writer.write((json.dumps(reply) + '\n').encode())
+        await writer.drain()
+        writer.close()
+
+async def read_http_request(reader):
+        """
+        Reads the request line, the headers and the body of one HTTP request.
+        :return: tuple (method, path, headers dict with lowercase names).
+        """
+        request_line = (await reader.readline()).decode('latin-1').split()
+        if len(request_line) != 3:
+                raise ValueError('malformed request line')
+        headers = {}
+        while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                        break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if not 0 <= length <= 1024 * 1024:
+                raise ValueError('bad Content-Length')
+        if length:
+                await reader.readexactly(length)
+        return request_line[0], request_line[1], headers
+
+async def serve_webhook(reader, writer, wakes, token):
+        """
+        Minimal HTTP endpoint for Prism alert webhooks. POST /<cluster ip or host> with the
+        shared token (X-Webhook-Token header or ?token=) re-polls that cluster right away.
+        Anything else is answered with an error status and triggers nothing.
+        """
+        import asyncio
+        import hmac
+        try:
+                method, target, headers = await asyncio.wait_for(read_http_request(reader), READ_TIMEOUT)
+        except asyncio.TimeoutError:
+                status = b'408 Request Timeout'
+        except (ValueError, asyncio.IncompleteReadError):
+                status = b'400 Bad Request'
+        else:
+                path, _, query = target.partition('?')
+                params = dict(param.partition('=')[::2] for param in query.split('&') if param)
+                supplied = headers.get('x-webhook-token') or params.get('token', '')
+                cluster = path.strip('/')
+                if method != 'POST':
+                        status = b'405 Method Not Allowed'
+                elif not hmac.compare_digest(supplied.encode('utf-8'), token.encode('utf-8')):
+                        status = b'401 Unauthorized'
+                elif cluster not in wakes:
+                        status = b'404 Not Found'
+                else:
+                        wakes[cluster].set()
+                        status = b'204 No Content'
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        await writer.drain()
+        writer.close()
+
+async def run_daemon(socket_path, clusters, username, password, atypes, status, concurrency, interval, full_sync,
+                     webhook_port=None, webhook_host='127.0.0.1', webhook_token=None, socket_group=None):
+        """
+        Long running collector: keeps the alert counts of every inventory cluster in memory
+        (delta polling through an in-memory state, reconciled on every poll so resolved
+        alarms drop out, see cluster_state and reconcile_state) and answers checks over a
+        Unix socket, so a check never waits on Prism Element.
+        The socket is only readable and writable by the daemon user and socket_group.
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        session = pooled_session(clusters)
+        semaphore = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+        cache = {}
+        state = {}
+        wakes = {}
+        names = {}
+        for cluster in clusters:
+                wakes[cluster['ip']] = wakes[cluster['host']] = asyncio.Event()
+                names[cluster['host']] = cluster['ip']
+
+        if os.path.exists(socket_path):
+                os.unlink(socket_path)
+        # created 0660 right away, no window where other users can connect
+        umask = os.umask(0o117)
+        try:
+                server = await asyncio.start_unix_server(lambda r, w: serve_query(r, w, cache, atypes, names), path=socket_path)
+        finally:
+                os.umask(umask)
+        if socket_group:
+                shutil.chown(socket_path, group=socket_group)
+        if webhook_port:
+                await asyncio.start_server(lambda r, w: serve_webhook(r, w, wakes, webhook_token), host=webhook_host, port=webhook_port)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                async with server:
+                        await asyncio.gather(*(
+                                watch_cluster(loop, executor, semaphore, session, cluster, username, password, atypes, status,
+                                              state, full_sync, interval, cache, wakes[cluster['ip']])
+                                for cluster in clusters))
+
+def query_daemon(socket_path, ip, atype, max_age):
+        """
+        Thin check: asks the daemon for the cached counts of one cluster. Data older than
+        max_age seconds, or no answer from the daemon, is reported as UNKNOWN.
+        """
+        atypes = [a.strip().upper() for a in atype.split(',') if a.strip()]
+        try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                        sock.settimeout(5)
+                        sock.connect(socket_path)
+                        sock.sendall((json.dumps({'ip': ip, 'atypes': atypes}) + '\n').encode())
+                        reply = json.loads(sock.makefile('rb').readline())
+        except (OSError, ValueError) as e:
+                print("UNKNOWN ALARM NUTANIX CLUSTER " + ip + f" (daemon unavailable: {e})")
+                sys.exit(3)
+        if 'results' not in reply:
+                print("UNKNOWN ALARM NUTANIX CLUSTER " + ip + f" ({reply.get('error')})")
+                sys.exit(3)
+        if reply['age'] > max_age:
+                info = "UNKNOWN ALARM NUTANIX CLUSTER " + ip + f" (STALE DATA, {reply['age']:.0f}s OLD"
+                if reply['error']:
+                        info += f", last error: {reply['error']}"
+                print(info + ")")
+                sys.exit(3)
+        for code, info in reply['results']:
+                print(info)
+        sys.exit(max(code for code, info in reply['results']))
 
 if __name__ == "__main__":
-    alerts(ip,username,password,atype,status)
-#    parser = argparse.ArgumentParser(description='EXAMPLE: python NUTANIX_CHECK_API_v1.4.py --ip 10.26.1.2 --username admin --password Pass1010., --atype CRITICAL.')
-#
-#    parser.add_argument('-v', '--version', action='version', version='%(prog)s v' + VERSION)
-#    parser.add_argument('--ip', required=True,
-#                        help='Nutanix REST API URL. Required. Ex: https://10.10.10.100:9440')
-#    parser.add_argument('--username', required=True,
-#                        help='Nutanix REST API Username. Required.')
-#    parser.add_argument('--password',required=True,
-#                        help='Nutanix REST API Password. Optional, is asked if it is omitted.')
-#    parser.add_argument('--atype', required=True,
-#                        help='Nutanix type of alarm , CRITICAL OR WARNING.')
-#    parser.add_argument('--resolved', required=True,
-#                        help='List resolved alarms or not (y/n).')
-#    args = parser.parse_args()
-#    password = args.password if args.password else getpass.getpass()
-#
-#    alerts(args.ip, args.username, password, args.atype, args.resolved)
+    parser = argparse.ArgumentParser(description='EXAMPLE: python check_nutanix.py --ip 10.26.1.2 --username admin --password Pass1010., --atype CRITICAL.')
+
+    parser.add_argument('-v', '--version', action='version', version='%(prog)s ' + VERSION)
+    parser.add_argument('--ip', default=ip,
+                        help='Nutanix cluster IP. Ex: 10.10.10.100')
+    parser.add_argument('--username', default=username,
+                        help='Nutanix REST API Username.')
+    parser.add_argument('--password', default=password,
+                        help='Nutanix REST API Password.')
+    parser.add_argument('--atype', default=atype,
+                        help='Nutanix type of alarm , CRITICAL OR WARNING, or CRITICAL,WARNING to check both with a single alerts call.')
+    parser.add_argument('--resolved', default=status,
+                        help='List resolved alarms or not (y/n).')
+    parser.add_argument('--days', type=float,
+                        help='Only alarms created in the last N days (start_time_in_usecs window), useful with --resolved y.')
+    parser.add_argument('--state',
+                        help='Alert state file. Keeps every alarm by cluster and alert UUID and only requests the details of the ones created, repeated, acknowledged or resolved since the last run.')
+    parser.add_argument('--full-sync', type=int, default=FULL_SYNC,
+                        help='Seconds between full alert fetches with --state, which rebuild the cache from scratch.')
+    parser.add_argument('--inventory',
+                        help='Cluster inventory file (ip[,host[,username[,password]]] per line). Polls every cluster concurrently and prints passive check results.')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help='Max clusters polled at the same time with --inventory.')
+    parser.add_argument('--service', default='NUTANIX ALARMS',
+                        help='Service description prefix for passive results, the alarm type is appended.')
+    parser.add_argument('--output',
+                        help='Write passive results to this check-result/command file instead of stdout.')
+    parser.add_argument('--daemon', metavar='SOCKET',
+                        help='Run as collector daemon for the --inventory clusters and answer checks on this Unix socket.')
+    parser.add_argument('--interval', type=int, default=INTERVAL,
+                        help='Seconds between polls of each cluster with --daemon.')
+    parser.add_argument('--webhook-port', type=int,
+                        help='With --daemon, listen for Prism alert webhooks on this port (POST /<cluster ip or host>) and re-poll that cluster at once.')
+    parser.add_argument('--webhook-host', default='127.0.0.1',
+                        help='Address the webhook listener binds to.')
+    parser.add_argument('--webhook-token', default=os.getenv('NUTANIX_WEBHOOK_TOKEN'),
+                        help='Shared secret the webhooks must send in the X-Webhook-Token header or as ?token=. Required with --webhook-port (default: $NUTANIX_WEBHOOK_TOKEN).')
+    parser.add_argument('--socket-group',
+                        help='With --daemon, group allowed to query the socket (it is created 0660).')
+    parser.add_argument('--socket',
+                        help='Answer the check from the --daemon listening on this Unix socket instead of calling Prism.')
+    parser.add_argument('--max-age', type=int, default=MAX_AGE,
+                        help='With --socket, seconds after which the daemon data is reported as UNKNOWN.')
+    args = parser.parse_args()
+
+    if args.socket:
+        query_daemon(args.socket, args.ip, args.atype, args.max_age)
+
+    if args.daemon or args.inventory:
+        import asyncio
+
+    if args.daemon:
+        if not args.inventory:
+            parser.error('--daemon needs --inventory')
+        if args.webhook_port and not args.webhook_token:
+            parser.error('--webhook-port needs --webhook-token')
+        atypes = [a.strip().upper() for a in args.atype.split(',') if a.strip()]
+        asyncio.run(run_daemon(args.daemon, read_inventory(args.inventory), args.username, args.password,
+                               atypes, args.resolved, args.concurrency, args.interval, args.full_sync,
+                               args.webhook_port, args.webhook_host, args.webhook_token, args.socket_group))
+
+    if args.inventory:
+        atypes = [a.strip().upper() for a in args.atype.split(',') if a.strip()]
+        state = load_state(args.state) if args.state else None
+        results = asyncio.run(poll_inventory(read_inventory(args.inventory), args.username, args.password,
+                                             atypes, args.resolved, args.concurrency, args.days, state, args.full_sync))
+        if state is not None:
+            save_state(args.state, state)
+        lines = "\n".join(passive_results(results, args.service)) + "\n"
+        if args.output:
+            with open(args.output, 'a') as f:
+                f.write(lines)
+        else:
+            sys.stdout.write(lines)
+        sys.exit(0)
+
+    # only for a person at a terminal, the first line Nagios reads must be the status
+    if sys.stdout.isatty():
+        banner()
+    alerts(args.ip, args.username, args.password, args.atype, args.resolved, args.days, args.state, args.full_sync)
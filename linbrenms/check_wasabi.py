@@ -1,16 +1,22 @@
 #!/usr/bin/env python3
 
-import datetime
-from email.message import EmailMessage
-
-import requests
-import smtplib
 import sys
 
+from wasabi_billing import MAX_AGE, load_billing, sum_totals
+
 warning = 0.8
 critical = 0.9
 wasabi_totals = 357840279024800
 
+# billing cache shared with check_wasabi_bucket.py, '' disables it.
+cache_path = None
+if("--cache" in  sys.argv):
+    cache_path = sys.argv[sys.argv.index("--cache") + 1]
+
+max_age = MAX_AGE
+if("--max-age" in  sys.argv):
+    max_age = int(sys.argv[sys.argv.index("--max-age") + 1])
+
 def calculate_size(size, _size_table):
     """
     This function dynamically calculates the right base unit symbol for size of the object.
@@ -37,38 +43,11 @@ if __name__ == '__main__':
     # Generate a table for SI units symbol table.
     size_table = {0: 'Bs', 1: 'KBs', 2: 'MBs', 3: 'GBs', 4: 'TBs', 5: 'PBs', 6: 'EBs'}
 
-    # request for the billing api
-    try:
-        response = requests.get("https://billing.wasabisys.com/utilization/bucket/",
-                                headers={"Authorization": f'{wasabi_access_key}:{wasabi_secret_key}'})
-    except Exception as e:
-        raise e
-
-    # get json data for billing
-    json_data = response.json()
-
-    # initialize a dict for adding up numbers
-    result = {'PaddedStorageSizeBytes': 0,
-              'NumBillableObjects': 0,
-              'DeletedStorageSizeBytes': 0,
-              'NumBillableDeletedObjects': 0
-              }
-
-    # get the initial time and check date only for this day.
-    initial_time = datetime.datetime.strptime(json_data[0]['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
-
-    # for each bucket add the the data to the dict
-    for bucket in json_data:
-        # check the time from the last day.
-        time = datetime.datetime.strptime(bucket['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
-        # summing logic.
-        if time.date() == initial_time.date():
-            result['PaddedStorageSizeBytes'] += bucket['PaddedStorageSizeBytes']
-            result['DeletedStorageSizeBytes'] += bucket['DeletedStorageSizeBytes']
-            result['NumBillableObjects'] += bucket['NumBillableObjects']
-            result['NumBillableDeletedObjects'] += bucket['NumBillableDeletedObjects']
+    # first day usage of every bucket, from the shared billing cache when it is fresh.
+    initial_date, usage = load_billing(wasabi_access_key, wasabi_secret_key, cache_path, max_age)
+    result = sum_totals(usage.values())
 
-    body = f"Billing Summary for {initial_time.date()}" + "\n" \
+    body = f"Billing Summary for {initial_date}" + "\n" \
            + 'Active storage: ' + calculate_size(result['PaddedStorageSizeBytes'], size_table) + "\n" \
            + 'Deleted storage: ' + calculate_size(result['DeletedStorageSizeBytes'], size_table) + "\n" \
            + 'Total Active objects: ' + str(result['NumBillableObjects']) + "\n" \
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
-import datetime
-import requests
 import sys
+import time
+
+from wasabi_billing import MAX_AGE, load_billing
 
 warning = 0.7
 critical = 0.8
@@ -17,6 +18,42 @@ contratado = "none"
 if("--contratado" in  sys.argv):
     contratado = int(sys.argv[sys.argv.index("--contratado") + 1])*1024*1024*1024*1024
 
+# billing cache shared with the other check runs, '' disables it.
+cache_path = None
+if("--cache" in  sys.argv):
+    cache_path = sys.argv[sys.argv.index("--cache") + 1]
+
+max_age = MAX_AGE
+if("--max-age" in  sys.argv):
+    max_age = int(sys.argv[sys.argv.index("--max-age") + 1])
+
+# batch mode: every customer of the contract CSV (path or url) in one run,
+# buckets assigned by a --mapping file (customer,bucket[,bucket...]) or by a --tag key.
+CONTRACT_CSV_URL = "https://velocityshare.s3.wasabisys.com/internal/wasabi_contract_customers.csv"
+batch = None
+if("--batch" in  sys.argv):
+    batch = sys.argv[sys.argv.index("--batch") + 1]
+
+mapping = None
+if("--mapping" in  sys.argv):
+    mapping = sys.argv[sys.argv.index("--mapping") + 1]
+
+tag = None
+if("--tag" in  sys.argv):
+    tag = sys.argv[sys.argv.index("--tag") + 1]
+
+host = "wasabi"
+if("--host" in  sys.argv):
+    host = sys.argv[sys.argv.index("--host") + 1]
+
+service = "WASABI CONTRACT"
+if("--service" in  sys.argv):
+    service = sys.argv[sys.argv.index("--service") + 1]
+
+output = None
+if("--output" in  sys.argv):
+    output = sys.argv[sys.argv.index("--output") + 1]
+
 def calculate_size(size, _size_table):
     """
     This function dynamically calculates the right base unit symbol for size of the object.
@@ -31,6 +68,116 @@ def calculate_size(size, _size_table):
     return str(round(size, 2)) + ' ' + _size_table[count]
 
 
+def read_contracts(source):
+    """
+    Contract CSV used by the exporter: header, then customer,site,contracted TiB[,...].
+    Rows of the same customer (several sites) are added up, invalid rows are skipped.
+    :param source: file path or http(s) url, 'default' for the velocityshare file.
+    :return: dict of customer -> contracted bytes.
+    """
+    if source == 'default':
+        source = CONTRACT_CSV_URL
+    if source.startswith('http://') or source.startswith('https://'):
+        import urllib.request
+        with urllib.request.urlopen(source, timeout=60) as response:
+            text = response.read().decode('utf-8')
+    else:
+        with open(source) as f:
+            text = f.read()
+
+    contracts = {}
+    for row in text.strip().splitlines()[1:]:
+        parts = row.strip().split(",")
+        if len(parts) < 3:
+            continue
+        try:
+            contract_bytes = int(parts[2].strip())*1024*1024*1024*1024
+        except ValueError:
+            continue
+        customer = parts[0].strip()
+        contracts[customer] = contracts.get(customer, 0) + contract_bytes
+    return contracts
+
+
+def read_mapping(path):
+    """
+    :return: dict of customer -> list of buckets, from lines customer,bucket[,bucket...].
+    """
+    customers = {}
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = [p.strip() for p in line.split(',')]
+            customers.setdefault(parts[0], []).extend(p for p in parts[1:] if p)
+    return customers
+
+
+def tag_mapping(access_key, secret_key, bucket_names, key):
+    """
+    :return: dict of customer -> list of buckets, the customer being the value of the
+             bucket tag `key`. Only imported and called with --tag (needs boto3).
+    """
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import ClientError
+    from concurrent.futures import ThreadPoolExecutor
+
+    s3_client = boto3.session.Session(
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        region_name='us-east-1'
+    ).client('s3', endpoint_url='https://s3.wasabisys.com', config=Config(max_pool_connections=16))
+
+    def customer_of(bucket):
+        try:
+            tag_set = s3_client.get_bucket_tagging(Bucket=bucket)['TagSet']
+        except ClientError:
+            return None  # no tags or access denied
+        return next((t['Value'] for t in tag_set if t['Key'] == key), None)
+
+    customers = {}
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for bucket, customer in zip(bucket_names, executor.map(customer_of, bucket_names)):
+            if customer:
+                customers.setdefault(customer, []).append(bucket)
+    return customers
+
+
+def evaluate_customers(contracts, customers, usage, _size_table):
+    """
+    One pass over the customers of the contract, bucket usage looked up in the first day usage.
+    :return: list of (customer, nagios code, status line).
+    """
+    results = []
+    for customer, contract in contracts.items():
+        names = [b for b in customers.get(customer, []) if b in usage]
+        if not names:
+            results.append((customer, 3, f'UNKNOWN: no known buckets mapped to {customer}'))
+            continue
+        total = sum(usage[b]['PaddedStorageSizeBytes'] for b in names)
+        ratio = total / contract if contract else float('inf')
+        info = (f'{customer}: {calculate_size(total, _size_table)} used of {calculate_size(contract, _size_table)}'
+                f' ({ratio:.1%}) in {len(names)} buckets')
+        if ratio > critical:
+            results.append((customer, 2, f'Critical: {info}'))
+        elif ratio > warning:
+            results.append((customer, 1, f'Warning: {info}'))
+        else:
+            results.append((customer, 0, f'OK: {info}'))
+    return results
+
+
+def passive_results(results):
+    """
+    Nagios/Icinga external command lines (PROCESS_SERVICE_CHECK_RESULT), one per customer.
+    """
+    now = int(time.time())
+    return [f"[{now}] PROCESS_SERVICE_CHECK_RESULT;{host};{service} {customer};{code};{info}"
+            for customer, code, info in results]
+
+
 if __name__ == '__main__':
     # Keys for accessing billing data.
     wasabi_access_key = ''
@@ -43,45 +190,36 @@ if __name__ == '__main__':
     # Generate a table for SI units symbol table.
     size_table = {0: 'Bs', 1: 'KiBs', 2: 'MiBs', 3: 'GiBs', 4: 'TiBs', 5: 'PiBs', 6: 'EiBs'}
 
-    # request for the billing api
-    try:
-        response = requests.get("https://billing.wasabisys.com/utilization/bucket/?withname=true",
-                                headers={"Authorization": f'{wasabi_access_key}:{wasabi_secret_key}'})
-    except Exception as e:
-        raise e
-
-    # get json data for billing
-    json_data = response.json()
-
-    # initialize a dict for adding up numbers
-
-    # get the initial time and check date only for this day.
-    initial_time = datetime.datetime.strptime(json_data[0]['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
-
-    def sizec(cbucket,json_data):
-        result = {'PaddedStorageSizeBytes': 0,
-                  'NumBillableObjects': 0,
-                  'DeletedStorageSizeBytes': 0,
-                  'NumBillableDeletedObjects': 0
-                  }
-
-        # for each bucket add the the data to the dict
-        for bucket in json_data:
-            if bucket['Bucket'] == cbucket:
-                # check the time from the last day.
-                time = datetime.datetime.strptime(bucket['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
-                # summing logic.
-                if time.date() == initial_time.date():
-                    result['PaddedStorageSizeBytes'] += bucket['PaddedStorageSizeBytes']
-                    result['DeletedStorageSizeBytes'] += bucket['DeletedStorageSizeBytes']
-                    result['NumBillableObjects'] += bucket['NumBillableObjects']
-                    result['NumBillableDeletedObjects'] += bucket['NumBillableDeletedObjects']
-                return result['PaddedStorageSizeBytes']
+    # checked before the billing call, a wrong command line must not cost a fetch.
+    if batch and not (mapping or tag):
+        print('--batch needs --mapping FILE or --tag KEY')
+        sys.exit(3)
+
+    # first day usage of every bucket, from the shared billing cache when it is fresh.
+    initial_date, latest = load_billing(wasabi_access_key, wasabi_secret_key, cache_path, max_age)
+
+    if batch:
+        contracts = read_contracts(batch)
+        if mapping:
+            customers = read_mapping(mapping)
+        else:
+            customers = tag_mapping(wasabi_access_key, wasabi_secret_key, list(latest), tag)
+        lines = "\n".join(passive_results(evaluate_customers(contracts, customers, latest, size_table))) + "\n"
+        if output:
+            with open(output, 'a') as f:
+                f.write(lines)
+        else:
+            sys.stdout.write(lines)
+        sys.exit(0)
+
+    def sizec(cbucket):
+        result = latest.get(cbucket)
+        return result['PaddedStorageSizeBytes'] if result else None
 
     try:
         total = 0
         for b in list_buckets:
-            a = sizec(b,json_data)
+            a = sizec(b)
             if a is None:
                 pass
             else:
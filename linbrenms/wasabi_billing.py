@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Shared helpers for the Wasabi billing checks (check_wasabi.py, check_wasabi_bucket.py).
+iter_json_array and aggregate_billing are also copied in wasabi/wasabi-exporter.py (its
+image is built from wasabi/ only), keep both copies in sync.
+"""
+
+import codecs
+import datetime
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import stat
+import struct
+import time
+
+BILLING_FIELDS = ('PaddedStorageSizeBytes',
+                  'DeletedStorageSizeBytes',
+                  'NumBillableObjects',
+                  'NumBillableDeletedObjects')
+
+
+CHUNK_SIZE = 64 * 1024
+BILLING_HOST = 'billing.wasabisys.com'
+TIMEOUT = 60
+MAX_AGE = 3600
+BILLING_PATH = '/utilization/bucket/?withname=true'
+
+# cache file: header (magic, first day ordinal, buckets), then per bucket
+# (name length, utf-8 name, the four BILLING_FIELDS counters).
+CACHE_MAGIC = b'WBC1'
+CACHE_HEADER = struct.Struct('<4sII')
+CACHE_NAME = struct.Struct('<H')
+CACHE_COUNTERS = struct.Struct('<4q')
+
+
+def billing_chunks(path, access_key, secret_key, timeout=TIMEOUT):
+    """
+    Minimal streamed HTTPS GET against the billing api on http.client, cheaper to import
+    than requests for a check that makes a single call. The body is asked gzipped and
+    inflated on the fly.
+    :param path: e.g. '/utilization/bucket/?withname=true'.
+    :return: generator of raw body chunks for iter_json_array.
+    """
+    import http.client
+    import zlib
+
+    conn = http.client.HTTPSConnection(BILLING_HOST, timeout=timeout)
+    try:
+        conn.request('GET', path, headers={'Authorization': f'{access_key}:{secret_key}',
+                                           'Accept-Encoding': 'gzip'})
+        response = conn.getresponse()
+        if response.status != 200:
+            raise RuntimeError(f'Billing api returned {response.status} {response.reason}')
+        inflate = None
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            inflate = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield inflate.decompress(chunk) if inflate else chunk
+        if inflate:
+            yield inflate.flush()
+    finally:
+        conn.close()
+
+
+def iter_json_array(chunks):
+    """
+    Parses a top level JSON array incrementally and yields its elements one by one,
+    so the whole billing payload never has to be held in memory.
+    :param chunks: iterable of bytes, e.g. response.iter_content(CHUNK_SIZE) of a stream=True request.
+    :return: generator of the decoded array elements.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # skip whitespace and separators between elements.
+        while pos < len(buf) and buf[pos] in ' \t\r\n,[':
+            if buf[pos] == '[':
+                if started:
+                    break
+                started = True
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf) and not started:
+            raise ValueError('Billing payload is not a JSON array')
+
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # a scalar ending exactly at the buffer edge may still be cut in half.
+                if end < len(buf) or eof or isinstance(item, (dict, list)):
+                    yield item
+                    pos = end
+                    continue
+
+        if eof:
+            raise ValueError('Billing payload ended before the closing bracket')
+        chunk = next(chunks, None)
+        if chunk is None:
+            buf = buf[pos:] + utf8.decode(b'', final=True)
+            eof = True
+        else:
+            buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+
+def empty_result():
+    """
+    :return: dict with every billing counter set to zero.
+    """
+    return dict.fromkeys(BILLING_FIELDS, 0)
+
+
+def aggregate_billing(json_data):
+    """
+    Walks the billing rows once and adds them up by (bucket, day).
+    StartTime comes as '%Y-%m-%dT%H:%M:%SZ', so the day is just the first 10 characters
+    and no row needs a strptime.
+    :param json_data: rows returned by the utilization/bucket billing api, a list or iter_json_array.
+    :return: tuple (date of the first row, dict of (bucket, 'YYYY-MM-DD') -> counters).
+    """
+    index = {}
+    first_start = None
+    for row in json_data:
+        start = row['StartTime']
+        if first_start is None:
+            first_start = start
+        key = (row['Bucket'], start[:10])
+        result = index.get(key)
+        if result is None:
+            result = index[key] = empty_result()
+        for field in BILLING_FIELDS:
+            result[field] += row[field]
+
+    if first_start is None:
+        raise ValueError('Billing payload has no rows')
+    initial_time = datetime.datetime.strptime(first_start, '%Y-%m-%dT%H:%M:%SZ')
+    return initial_time.date(), index
+
+
+def day_totals(index, day):
+    """
+    :param index: dict returned by aggregate_billing.
+    :param day: datetime.date to keep.
+    :return: dict of bucket -> counters for that day only.
+    """
+    day = day.isoformat()
+    return {bucket: result for (bucket, bucket_day), result in index.items() if bucket_day == day}
+
+
+def sum_totals(totals):
+    """
+    :param totals: iterable of counter dicts.
+    :return: dict with the counters added up.
+    """
+    result = empty_result()
+    for item in totals:
+        for field in BILLING_FIELDS:
+            result[field] += item[field]
+    return result
+
+
+def first_day_usage(index, day):
+    """
+    :param index: dict returned by aggregate_billing.
+    :param day: datetime.date to keep.
+    :return: dict of bucket -> counters for that day, for every bucket of the payload
+             (all zero when the bucket has no row that day).
+    """
+    usage = {bucket: empty_result() for bucket, _ in index}
+    usage.update(day_totals(index, day))
+    return usage
+
+
+def private_dir(path):
+    """
+    Creates path with mode 0700 when missing.
+    :raise OSError: when it is a symlink, not a directory, owned by another user or open
+                    to group/others (another local user could plant or swap cache files).
+    """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise OSError(f'unsafe cache directory {path}')
+    return path
+
+
+def default_cache_path(access_key, path=BILLING_PATH):
+    """
+    One cache file per account and api path in a per-user 0700 directory of $TMPDIR,
+    shared by every check run of that user.
+    """
+    digest = hashlib.sha1(f'{access_key}|{path}'.encode()).hexdigest()[:16]
+    directory = private_dir(os.path.join(os.environ.get('TMPDIR', '/tmp'), f'wasabi_billing-{os.getuid()}'))
+    return os.path.join(directory, f'{digest}.cache')
+
+
+def write_cache(cache_path, day, usage):
+    parts = [CACHE_HEADER.pack(CACHE_MAGIC, day.toordinal(), len(usage))]
+    for bucket, result in usage.items():
+        name = bucket.encode('utf-8')
+        parts.append(CACHE_NAME.pack(len(name)))
+        parts.append(name)
+        parts.append(CACHE_COUNTERS.pack(*(result[field] for field in BILLING_FIELDS)))
+    # only the refreshing process gets here, the read path does not pay for this import.
+    import tempfile
+    # fresh random name opened O_EXCL|O_NOFOLLOW with mode 0600: never writes through a
+    # file or symlink planted next to the cache, and a leftover of a killed run is no clash.
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_path) or '.',
+                               prefix=os.path.basename(cache_path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b''.join(parts))
+        os.replace(tmp, cache_path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def read_cache(cache_path, max_age):
+    """
+    :return: tuple (day, usage) from a cache file younger than max_age seconds, else None.
+             Files owned by another user or writable by group/others are ignored, and so
+             are truncated or corrupt ones (they are rewritten by the next fetch).
+    """
+    try:
+        fd = os.open(cache_path, os.O_RDONLY | os.O_NOFOLLOW)
+    except OSError:
+        return None
+    with os.fdopen(fd, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_uid != os.getuid() or st.st_mode & 0o022 or not stat.S_ISREG(st.st_mode):
+            return None
+        if time.time() - st.st_mtime > max_age or st.st_size < CACHE_HEADER.size:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, ordinal, count = CACHE_HEADER.unpack_from(mm, 0)
+            if magic != CACHE_MAGIC:
+                return None
+            offset = CACHE_HEADER.size
+            usage = {}
+            try:
+                for _ in range(count):
+                    (length,) = CACHE_NAME.unpack_from(mm, offset)
+                    offset += CACHE_NAME.size
+                    if offset + length > len(mm):
+                        return None
+                    bucket = mm[offset:offset + length].decode('utf-8')
+                    offset += length
+                    usage[bucket] = dict(zip(BILLING_FIELDS, CACHE_COUNTERS.unpack_from(mm, offset)))
+                    offset += CACHE_COUNTERS.size
+                day = datetime.date.fromordinal(ordinal)
+            except (struct.error, ValueError):
+                # struct.error: cut short, ValueError: bad utf-8 name or day ordinal
+                return None
+    return day, usage
+
+
+def load_billing(access_key, secret_key, cache_path=None, max_age=MAX_AGE):
+    """
+    First day usage of every bucket, shared between check processes through a cache file.
+    A fresh cache is read without any api call or JSON parsing. When it is stale, the
+    first process to take the lock fetches and rewrites it while the others wait on the
+    lock and then reuse its result, so concurrent checks make a single billing call.
+    :param cache_path: cache file, default_cache_path() when None; '' disables the cache.
+    :param max_age: seconds a cached result is reused (billing data changes daily).
+    :return: tuple (date of the first row, dict returned by first_day_usage).
+    """
+    def fetch():
+        day, index = aggregate_billing(iter_json_array(billing_chunks(BILLING_PATH, access_key, secret_key)))
+        return day, first_day_usage(index, day)
+
+    if cache_path == '' or max_age <= 0:
+        return fetch()
+    if cache_path is None:
+        try:
+            cache_path = default_cache_path(access_key)
+        except OSError:
+            # no private directory to keep it in, fetch without the cache
+            return fetch()
+
+    cached = read_cache(cache_path, max_age)
+    if cached:
+        return cached
+    with os.fdopen(os.open(cache_path + '.lock', os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # another process may have refreshed it while this one waited for the lock
+        cached = read_cache(cache_path, max_age)
+        if cached:
+            return cached
+        day, usage = fetch()
+        write_cache(cache_path, day, usage)
+        return day, usage
@@ -0,0 +1,16 @@
+# Modo producción: gunicorn -c gunicorn.conf.py
+# Los eventos se comparten por SQLite ([events] db); la precarga de proyectos la hace
+# un solo worker (prefetch_lock) y el resto lee project_cache_file.
+import os
+import importlib
+
+wsgi_app = "webhook:app"
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = 60
+keepalive = 5
+
+def post_worker_init(worker):
+    importlib.import_module("webhook").start_background_tasks()
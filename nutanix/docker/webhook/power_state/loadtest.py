@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga del webhook contra dobles locales: requests/seg y latencias p50/p99.
+
+Levanta un SMTP local que acepta y descarta los correos, siembra project_cache_file con
+las VMs de prueba (Prism Central no se consulta) y arranca el webhook en un directorio
+temporal, con gunicorn (gunicorn.conf.py) o con el servidor de desarrollo (--dev, puerto 5000).
+
+    python3 loadtest.py [--dev] [--duration 10] [--concurrency 32] [--events-ratio 0.1]
+"""
+import argparse
+import asyncio
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROJECT = "LOADTEST"
+
+
+async def smtp_session(reader, writer):
+    """
+    SMTP mínimo: responde OK a todo y descarta el contenido de DATA.
+    """
+    writer.write(b"220 loadtest ESMTP\r\n")
+    in_data = False
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        if in_data:
+            if line == b".\r\n":
+                in_data = False
+                writer.write(b"250 OK\r\n")
+            continue
+        command = line[:4].upper()
+        if command == b"DATA":
+            in_data = True
+            writer.write(b"354 End data with <CR><LF>.<CR><LF>\r\n")
+        elif command == b"QUIT":
+            writer.write(b"221 Bye\r\n")
+            await writer.drain()
+            break
+        else:
+            writer.write(b"250 OK\r\n")
+        await writer.drain()
+    writer.close()
+
+
+def start_smtp_sink():
+    """
+    :return: puerto del SMTP local (corre en un thread daemon).
+    """
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(smtp_session, "127.0.0.1", 0))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server.sockets[0].getsockname()[1]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def write_config(directory, smtp_port, vms):
+    """
+    config.ini de prueba y cache de proyectos: la mitad de las VMs en PROJECT.
+    """
+    expires = time.time() + 86400
+    with open(os.path.join(directory, "project_cache.json"), "w") as f:
+        json.dump({vm: [expires, PROJECT if i % 2 == 0 else "other"] for i, vm in enumerate(vms)}, f)
+    with open(os.path.join(directory, "config.ini"), "w") as f:
+        f.write(f"""[general]
+project_filter = {PROJECT}
+prism_central = 127.0.0.1
+prism_user = loadtest
+prism_pass = loadtest
+prism_timeout = 1
+project_cache_file = project_cache.json
+prefetch_interval = 0
+prefetch_lock = prefetch.lock
+
+[smtp]
+server = 127.0.0.1
+port = {smtp_port}
+from = loadtest@localhost
+to = loadtest@localhost
+digest_window = 1
+
+[events]
+db = events.db
+""")
+
+
+def webhook_payload(vm):
+    return json.dumps({
+        "event_type": random.choice(["VM.ON", "VM.OFF"]),
+        "entity_reference": {"uuid": vm},
+        "data": {"metadata": {"status": {"name": f"vm-{vm[:8]}",
+                                         "resources": {"nic_list": [{"ip_endpoint_list": [{"ip": "10.0.0.1"}]}]}}}},
+    })
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"webhook did not start on port {port}")
+
+
+def client(port, vms, deadline, events_ratio, latencies, errors):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            if random.random() < events_ratio:
+                conn.request("GET", "/events?limit=100")
+            else:
+                conn.request("POST", "/webhook", body=webhook_payload(random.choice(vms)),
+                             headers={"Content-Type": "application/json"})
+            response = conn.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dev", action="store_true", help="servidor de desarrollo de Flask en vez de gunicorn")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--events-ratio", type=float, default=0.1, help="fracción de GET /events")
+    parser.add_argument("--vms", type=int, default=1000)
+    args = parser.parse_args()
+
+    vms = [f"{i:08x}-0000-4000-8000-000000000000" for i in range(args.vms)]
+    with tempfile.TemporaryDirectory() as directory:
+        write_config(directory, start_smtp_sink(), vms)
+        if args.dev:
+            port = 5000
+            command = [sys.executable, os.path.join(HERE, "webhook.py")]
+        else:
+            port = free_port()
+            command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(HERE, "gunicorn.conf.py"),
+                       "--pythonpath", HERE, "--bind", f"127.0.0.1:{port}"]
+        server = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for(port)
+            latencies, errors = [], []
+            deadline = time.monotonic() + args.duration
+            threads = [threading.Thread(target=client, args=(port, vms, deadline, args.events_ratio, latencies, errors))
+                       for _ in range(args.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.terminate()
+            server.wait()
+
+    mode = "flask dev server" if args.dev else "gunicorn"
+    print(f"{mode}: {len(latencies)} requests in {args.duration:.0f}s, {len(errors)} errors")
+    print(f"{len(latencies) / args.duration:.1f} req/s  p50 {percentile(latencies, 0.5) * 1000:.1f} ms"
+          f"  p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
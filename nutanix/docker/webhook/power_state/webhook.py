@@ -1,9 +1,17 @@
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, request, jsonify
 from datetime import datetime, timezone
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+from collections import OrderedDict, deque
+import os
+import json
 import uuid
+import time
+import queue
+import sqlite3
+import fcntl
+import threading
 import requests
 import urllib3
 import configparser
@@ -12,7 +20,6 @@ import configparser
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 app = Flask(__name__)
-captured_events = []
 
 # Leer configuración
 config = configparser.ConfigParser()
@@ -22,16 +29,134 @@ PROJECT_FILTER = config['general']['project_filter']
 PRISM_CENTRAL = config['general']['prism_central']
 PRISM_USER = config['general']['prism_user']
 PRISM_PASS = config['general']['prism_pass']
+PRISM_TIMEOUT = config['general'].getfloat('prism_timeout', 10)
+PROJECT_CACHE_TTL = config['general'].getint('project_cache_ttl', 3600)
+PROJECT_CACHE_SIZE = config['general'].getint('project_cache_size', 10000)
+PROJECT_CACHE_FILE = config['general'].get('project_cache_file', '')  # vacío = solo memoria
+PREFETCH_INTERVAL = config['general'].getint('prefetch_interval', 900)  # 0 = sin prefetch
+PREFETCH_LOCK = config['general'].get('prefetch_lock', 'data/prefetch.lock')
 
 SMTP_SERVER = config['smtp']['server']
 SMTP_PORT = int(config['smtp']['port'])
 EMAIL_FROM = config['smtp']['from']
 EMAIL_TO = config['smtp']['to']
+SMTP_WORKERS = config['smtp'].getint('workers', 1)
+SMTP_MAX_RETRIES = config['smtp'].getint('max_retries', 5)
+SMTP_IDLE = config['smtp'].getint('idle_timeout', 60)  # segundos antes de cerrar la sesión SMTP
+DIGEST_WINDOW = config['smtp'].getfloat('digest_window', 5)  # segundos para agrupar eventos
+DIGEST_MAX = config['smtp'].getint('digest_max', 50)
 
-# --- Función para enviar correo ---
-def send_email(event_record):
-    subject = f"[Nutanix VM] Evento de energía: {event_record['event_type'].upper()}"
-    body = f"""
+EVENTS_DB = config.get('events', 'db', fallback='data/events.db')
+EVENTS_MEMORY = config.getint('events', 'memory', fallback=500)  # eventos recientes en memoria
+WEB_LIMIT = config.getint('events', 'web_limit', fallback=100)  # eventos mostrados en /web
+PAGE_LIMIT = config.getint('events', 'page_limit', fallback=1000)  # máximo por página en /events
+
+email_queue = queue.Queue()
+
+# --- Almacén de eventos: ring buffer en memoria + SQLite en disco ---
+class EventStore:
+    """
+    Los eventos se agregan a una tabla SQLite indexada (sobrevive reinicios) y a un
+    deque acotado con los más recientes, que es lo único que lee /web. Con varios
+    workers la tabla es la fuente común: cada proceso trae a su deque solo las filas
+    nuevas (id > último visto).
+    """
+    FIELDS = ('event_type', 'vm_name', 'vm_ip', 'timestamp')
+
+    def __init__(self, path, memory):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS events ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " received_at REAL NOT NULL,"
+            " event_type TEXT, vm_name TEXT, vm_ip TEXT, timestamp TEXT)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_received_at ON events (received_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_vm_name ON events (vm_name, received_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS events_event_type ON events (event_type, received_at)")
+        self.conn.commit()
+        self.memory = memory
+        self.recent_events = deque(maxlen=memory)
+        self.last_id = 0
+        self.sync()
+
+    def sync(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, event_type, vm_name, vm_ip, timestamp FROM events WHERE id > ? ORDER BY id DESC LIMIT ?",
+                (self.last_id, self.memory)
+            ).fetchall()
+            for row in reversed(rows):
+                self.recent_events.append(dict(zip(self.FIELDS, row[1:])))
+            if rows:
+                self.last_id = rows[0][0]
+
+    def add(self, event_record):
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT INTO events (received_at, event_type, vm_name, vm_ip, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    (time.time(),) + tuple(event_record[f] for f in self.FIELDS)
+                )
+
+    def recent(self, limit):
+        self.sync()
+        with self.lock:
+            events = list(self.recent_events)
+        return events[-limit:]
+
+    def query(self, limit, offset=0, since=None, until=None, vm_name=None, event_type=None, newest_first=False):
+        where = []
+        params = []
+        if since is not None:
+            where.append("received_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("received_at < ?")
+            params.append(until)
+        if vm_name:
+            where.append("vm_name = ?")
+            params.append(vm_name)
+        if event_type:
+            where.append("event_type = ?")
+            params.append(event_type.lower())
+        sql = "SELECT event_type, vm_name, vm_ip, timestamp FROM events"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY id DESC" if newest_first else " ORDER BY id"
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit, offset]
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [dict(zip(self.FIELDS, row)) for row in rows]
+
+event_store = EventStore(EVENTS_DB, EVENTS_MEMORY)
+
+def parse_time_arg(value):
+    """
+    Acepta epoch en segundos o fecha ISO 8601 (sin zona = UTC).
+    """
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        return dt.timestamp()
+
+# --- Construir correo (un evento o resumen de varios) ---
+def build_email(events):
+    if len(events) == 1:
+        event_record = events[0]
+        subject = f"[Nutanix VM] Evento de energía: {event_record['event_type'].upper()}"
+        body = f"""
     Se ha registrado un evento de energía en una VM Nutanix.
 
     🔌 Tipo de evento: {event_record['event_type']}
@@ -39,6 +164,17 @@ def send_email(event_record):
     🌐 IP de la VM: {event_record['vm_ip']}
     🕒 Timestamp: {event_record['timestamp']}
     """
+    else:
+        subject = f"[Nutanix VM] {len(events)} eventos de energía"
+        rows = "\n".join(
+            f"    {e['timestamp']}  {e['event_type'].upper():<12} {e['vm_name']} ({e['vm_ip']})"
+            for e in events
+        )
+        body = f"""
+    Se han registrado {len(events)} eventos de energía en VMs Nutanix.
+
+{rows}
+    """
 
     message = MIMEMultipart()
     message["From"] = EMAIL_FROM
@@ -46,22 +182,154 @@ def send_email(event_record):
     message["Subject"] = subject
     message["Message-ID"] = f"<{uuid.uuid4()}@velocitycloud.us>"
     message.attach(MIMEText(body, "plain"))
+    return message
 
-    try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            server.sendmail(EMAIL_FROM, EMAIL_TO, message.as_string())
-        print("📧 Correo enviado con éxito.")
-    except Exception as e:
-        print(f"❌ Error al enviar correo: {e}")
+# --- Cola de envío de correos ---
+class EmailWorker(threading.Thread):
+    """
+    Toma eventos de email_queue, agrupa ráfagas en un solo correo y los envía
+    reutilizando una sesión SMTP, con reintentos y backoff exponencial.
+    """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.smtp = None
+
+    def close(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except Exception:
+                pass
+            self.smtp = None
+
+    def collect(self, first):
+        events = [first]
+        deadline = time.monotonic() + DIGEST_WINDOW
+        while len(events) < DIGEST_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                events.append(email_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return events
+
+    def send(self, events):
+        message = build_email(events).as_string()
+        for attempt in range(SMTP_MAX_RETRIES + 1):
+            try:
+                if self.smtp is None:
+                    self.smtp = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+                self.smtp.sendmail(EMAIL_FROM, EMAIL_TO, message)
+                print(f"📧 Correo enviado con éxito ({len(events)} evento(s)).")
+                return
+            except Exception as e:
+                print(f"❌ Error al enviar correo (intento {attempt + 1}): {e}")
+                self.close()
+                if attempt < SMTP_MAX_RETRIES:
+                    time.sleep(min(2 ** attempt, 60))
+        print(f"❌ Correo descartado tras {SMTP_MAX_RETRIES + 1} intentos ({len(events)} evento(s)).")
+
+    def run(self):
+        while True:
+            try:
+                first = email_queue.get(timeout=SMTP_IDLE)
+            except queue.Empty:
+                self.close()  # sesión ociosa, se reabre con el próximo evento
+                continue
+            events = self.collect(first)
+            try:
+                self.send(events)
+            finally:
+                for _ in events:
+                    email_queue.task_done()
+
+def start_email_workers():
+    for _ in range(SMTP_WORKERS):
+        EmailWorker().start()
+
+def send_email(event_record):
+    """
+    Encola el evento; el envío real lo hace EmailWorker fuera de la request.
+    """
+    email_queue.put(event_record)
+
+# --- Sesión HTTP con Prism Central (conexiones reutilizadas) ---
+prism_session = requests.Session()
+prism_session.auth = (PRISM_USER, PRISM_PASS)
+prism_session.verify = False
+
+# --- Cache UUID de VM -> proyecto ---
+class ProjectCache:
+    """
+    Cache con TTL y expulsión LRU. Guarda también las VMs sin proyecto (None),
+    por eso get() devuelve (encontrado, proyecto). Opcionalmente persiste en un JSON.
+    """
+    def __init__(self, ttl, max_size, path=''):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()  # uuid -> (expira, proyecto)
+        self.lock = threading.Lock()
+
+    def get(self, vm_uuid):
+        with self.lock:
+            entry = self.entries.get(vm_uuid)
+            if entry is None or entry[0] <= time.time():
+                return False, None
+            self.entries.move_to_end(vm_uuid)
+            return True, entry[1]
+
+    def put(self, vm_uuid, project):
+        with self.lock:
+            self.entries[vm_uuid] = (time.time() + self.ttl, project)
+            self.entries.move_to_end(vm_uuid)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except Exception as e:
+            print(f"⚠️ No se pudo leer la cache de proyectos: {e}")
+            return
+        now = time.time()
+        with self.lock:
+            for vm_uuid, (expires, project) in saved.items():
+                if expires > now:
+                    self.entries[vm_uuid] = (expires, project)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            saved = dict(self.entries)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(saved, f)
+        os.replace(tmp, self.path)
+
+project_cache = ProjectCache(PROJECT_CACHE_TTL, PROJECT_CACHE_SIZE, PROJECT_CACHE_FILE)
 
 # --- Obtener proyecto desde Prism Central ---
 def get_project_from_vm(vm_uuid):
+    found, project = project_cache.get(vm_uuid)
+    if found:
+        return project
     try:
         url = f"https://{PRISM_CENTRAL}:9440/api/nutanix/v3/vms/{vm_uuid}"
-        response = requests.get(url, auth=(PRISM_USER, PRISM_PASS), verify=False)
+        response = prism_session.get(url, timeout=PRISM_TIMEOUT)
         if response.status_code == 200:
             vm_data = response.json()
-            return vm_data.get("metadata", {}).get("project_reference", {}).get("name")
+            project = vm_data.get("metadata", {}).get("project_reference", {}).get("name")
+            project_cache.put(vm_uuid, project)
+            return project
         else:
             print(f"⚠️ Error al consultar Prism Central: {response.status_code}")
             return None
@@ -69,6 +337,63 @@ def get_project_from_vm(vm_uuid):
         print(f"❌ Error al obtener datos de la VM: {e}")
         return None
 
+# --- Precarga periódica de proyectos con vms/list ---
+def prefetch_projects():
+    """
+    Recorre vms/list paginado y guarda el proyecto de cada VM. Se cargan todas las VMs
+    (no solo las de PROJECT_FILTER) para que los eventos de VMs de otros proyectos
+    también se descarten sin consultar Prism Central.
+    """
+    url = f"https://{PRISM_CENTRAL}:9440/api/nutanix/v3/vms/list"
+    offset = 0
+    length = 500
+    while True:
+        response = prism_session.post(url, json={"kind": "vm", "offset": offset, "length": length}, timeout=PRISM_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        entities = data.get("entities", [])
+        for vm in entities:
+            metadata = vm.get("metadata", {})
+            if metadata.get("uuid"):
+                project_cache.put(metadata["uuid"], metadata.get("project_reference", {}).get("name"))
+        offset += len(entities)
+        if not entities or offset >= data.get("metadata", {}).get("total_matches", 0):
+            return offset
+
+def prefetch_loop():
+    """
+    Con varios workers solo el que obtiene PREFETCH_LOCK consulta vms/list y guarda
+    project_cache_file; los demás recargan ese archivo. Sin archivo compartido cada
+    worker hace su propia precarga.
+    """
+    directory = os.path.dirname(PREFETCH_LOCK)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    lock_file = open(PREFETCH_LOCK, 'w')
+    leader = False
+    while True:
+        if not leader:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                leader = True
+            except OSError:
+                pass
+        try:
+            if leader or not PROJECT_CACHE_FILE:
+                count = prefetch_projects()
+                project_cache.save()
+                print(f"🗂 Proyectos precargados para {count} VMs.")
+            else:
+                project_cache.load()
+        except Exception as e:
+            print(f"❌ Error en la precarga de proyectos: {e}")
+        time.sleep(PREFETCH_INTERVAL)
+
+def start_project_prefetch():
+    project_cache.load()
+    if PREFETCH_INTERVAL > 0:
+        threading.Thread(target=prefetch_loop, daemon=True).start()
+
 # --- Ruta principal del webhook ---
 @app.route('/webhook', methods=['POST'])
 def nutanix_webhook():
@@ -108,7 +433,7 @@ def nutanix_webhook():
             "vm_ip": vm_ip,
             "timestamp": timestamp
         }
-        captured_events.append(event_record)
+        event_store.add(event_record)
         print("✅ Evento registrado:", event_record)
         send_email(event_record)
         return jsonify({"status": "event captured", "event": event_record}), 200
@@ -118,11 +443,27 @@ def nutanix_webhook():
 # --- Ver historial de eventos ---
 @app.route('/events', methods=['GET'])
 def get_events():
-    return jsonify(captured_events), 200
+    """
+    Parámetros opcionales: limit, offset, since, until (epoch o ISO 8601),
+    vm_name, event_type y order=asc (por defecto los más recientes primero).
+    """
+    try:
+        # SQLite toma LIMIT -1 como sin límite: se acota a [0, PAGE_LIMIT]
+        limit = max(0, min(int(request.args.get('limit', 100)), PAGE_LIMIT))
+        offset = max(0, int(request.args.get('offset', 0)))
+        since = parse_time_arg(request.args.get('since'))
+        until = parse_time_arg(request.args.get('until'))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid query parameter: {e}"}), 400
+    events = event_store.query(
+        limit, offset, since, until,
+        vm_name=request.args.get('vm_name'),
+        event_type=request.args.get('event_type'),
+        newest_first=request.args.get('order') != 'asc'
+    )
+    return jsonify(events), 200
 
-@app.route('/web', methods=['GET'])
-def view_events():
-    html_template = """
+WEB_TEMPLATE = app.jinja_env.from_string("""
     <!doctype html>
     <html>
     <head>
@@ -137,6 +478,7 @@ def view_events():
     </head>
     <body>
         <h2>Eventos VMs Nutanix</h2>
+        <p>Últimos {{ events|length }} eventos, historial completo en /events</p>
         <table>
             <tr>
                 <th>Timestamp</th>
@@ -155,9 +497,18 @@ def view_events():
         </table>
     </body>
     </html>
-    """
-    return render_template_string(html_template, events=captured_events)
+    """)
+
+@app.route('/web', methods=['GET'])
+def view_events():
+    return WEB_TEMPLATE.render(events=event_store.recent(WEB_LIMIT))
+
+# --- Tareas en segundo plano (también las inicia gunicorn.conf.py en cada worker) ---
+def start_background_tasks():
+    start_email_workers()
+    start_project_prefetch()
 
 # --- Iniciar la app ---
 if __name__ == '__main__':
+    start_background_tasks()
     app.run(host='0.0.0.0', port=5000)
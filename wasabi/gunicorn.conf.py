@@ -0,0 +1,19 @@
+# Modo producción: gunicorn -c gunicorn.conf.py
+# Un solo worker recolecta (lock en COLLECTOR_LOCK) y publica el snapshot en
+# SNAPSHOT_FILE; el resto solo sirve /metrics desde ese archivo.
+import os
+import importlib
+
+os.environ.setdefault("SNAPSHOT_FILE", "data/metrics.prom")
+
+wsgi_app = "wasabi-exporter:app"
+bind = os.getenv("BIND", "0.0.0.0:9150")
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = 60
+keepalive = 5
+accesslog = None
+
+def post_worker_init(worker):
+    importlib.import_module("wasabi-exporter").start_background_thread()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Prueba de carga de /metrics contra dobles locales: requests/seg y latencias p50/p99.
+
+Siembra SNAPSHOT_FILE con una exposición sintética de --buckets buckets y toma
+COLLECTOR_LOCK, así ningún worker recolecta (no se llama a Wasabi) y todos sirven ese
+snapshot. Arranca el exporter con gunicorn (gunicorn.conf.py) o con el servidor de
+desarrollo (--dev, puerto 9150).
+
+    python3 loadtest.py [--dev] [--duration 10] [--concurrency 32] [--buckets 4000] [--no-gzip]
+"""
+import argparse
+import fcntl
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def write_snapshot(path, buckets):
+    lines = []
+    for metric in ('wasabi_active_storage_bytes', 'wasabi_deleted_storage_bytes',
+                   'wasabi_billable_objects', 'wasabi_deleted_billable_objects'):
+        lines.append(f'# HELP {metric} Synthetic load test series')
+        lines.append(f'# TYPE {metric} gauge')
+        lines.extend(f'{metric}{{bucket="bucket-{i:05d}",customer="customer-{i % 50}"}} {i * 1024}'
+                     for i in range(buckets))
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"exporter did not start on port {port}")
+
+
+def client(port, deadline, headers, latencies, errors, sizes):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            conn.request("GET", "/metrics", headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+            if response.status != 200:
+                errors.append(response.status)
+        except (OSError, http.client.HTTPException) as e:
+            errors.append(str(e))
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - start)
+        sizes.append(len(body))
+    conn.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else float("nan")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dev", action="store_true", help="servidor de desarrollo de Flask en vez de gunicorn")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--buckets", type=int, default=4000)
+    parser.add_argument("--no-gzip", action="store_true", help="pedir /metrics sin Accept-Encoding: gzip")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = dict(os.environ,
+                   SNAPSHOT_FILE=os.path.join(directory, "metrics.prom"),
+                   COLLECTOR_LOCK=os.path.join(directory, "collector.lock"),
+                   BILLING_DB=os.path.join(directory, "wasabi_billing.db"),
+                   REFRESH_TRIGGER=os.path.join(directory, "refresh.trigger"))
+        write_snapshot(env["SNAPSHOT_FILE"], args.buckets)
+        lock = open(env["COLLECTOR_LOCK"], "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)  # ningún worker llega a recolectar
+
+        if args.dev:
+            port = 9150
+            command = [sys.executable, os.path.join(HERE, "wasabi-exporter.py")]
+        else:
+            port = free_port()
+            command = [sys.executable, "-m", "gunicorn", "-c", os.path.join(HERE, "gunicorn.conf.py"),
+                       "--pythonpath", HERE, "--bind", f"127.0.0.1:{port}"]
+        server = subprocess.Popen(command, cwd=directory, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for(port)
+            headers = {} if args.no_gzip else {"Accept-Encoding": "gzip"}
+            latencies, errors, sizes = [], [], []
+            deadline = time.monotonic() + args.duration
+            threads = [threading.Thread(target=client, args=(port, deadline, headers, latencies, errors, sizes))
+                       for _ in range(args.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.terminate()
+            server.wait()
+            lock.close()
+
+    mode = "flask dev server" if args.dev else "gunicorn"
+    size = sum(sizes) / len(sizes) / 1024 if sizes else 0
+    print(f"{mode}: {len(latencies)} requests in {args.duration:.0f}s, {len(errors)} errors, {size:.0f} KiB per response")
+    print(f"{len(latencies) / args.duration:.1f} req/s  p50 {percentile(latencies, 0.5) * 1000:.1f} ms"
+          f"  p99 {percentile(latencies, 0.99) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
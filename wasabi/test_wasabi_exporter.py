@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Tests del exporter sin acceso a Wasabi: python -m unittest test_wasabi_exporter (desde wasabi/).
+"""
+import importlib.util
+import os
+import threading
+import unittest
+from unittest import mock
+
+from botocore.exceptions import ClientError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+spec = importlib.util.spec_from_file_location('wasabi_exporter', os.path.join(HERE, 'wasabi-exporter.py'))
+exporter = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(exporter)
+
+
+class FakeS3:
+    """
+    Cliente S3 mínimo: get_bucket_tagging sobre un dict bucket -> tags.
+    """
+    def __init__(self, tags):
+        self.tags = tags
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def get_bucket_tagging(self, Bucket):
+        with self.lock:
+            self.calls.append(Bucket)
+        if not self.tags.get(Bucket):
+            raise ClientError({'Error': {'Code': 'NoSuchTagSet', 'Message': 'no tags'}}, 'GetBucketTagging')
+        return {'TagSet': [{'Key': k, 'Value': v} for k, v in self.tags[Bucket].items()]}
+
+
+class FetchBucketTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = exporter.tag_cache = exporter.TagCache(ttl=3600, max_size=100)
+        self.client = FakeS3({'a': {'customer': 'acme'}, 'b': {'customer': 'globex', 'env': 'prod'}, 'c': {}})
+
+    def test_fetches_tags_through_the_client(self):
+        tags = exporter.fetch_bucket_tags(self.client, ['a', 'b', 'c'])
+        self.assertEqual(tags, {'a': {'customer': 'acme'}, 'b': {'customer': 'globex', 'env': 'prod'}, 'c': {}})
+        self.assertEqual(sorted(self.client.calls), ['a', 'b', 'c'])
+        self.assertEqual(len(self.cache.entries), 3)
+
+    def test_second_call_is_served_from_cache(self):
+        exporter.fetch_bucket_tags(self.client, ['a', 'b', 'c'])
+        self.client.calls.clear()
+        tags = exporter.fetch_bucket_tags(self.client, ['a', 'b', 'c', 'd'])
+        self.assertEqual(self.client.calls, ['d'])  # solo el bucket nuevo
+        self.assertEqual(tags['b'], {'customer': 'globex', 'env': 'prod'})
+        self.assertEqual((self.cache.hits, self.cache.misses), (3, 4))
+
+    def test_expired_entry_is_fetched_again(self):
+        self.cache.ttl = 0
+        exporter.fetch_bucket_tags(self.client, ['a'])
+        exporter.fetch_bucket_tags(self.client, ['a'])
+        self.assertEqual(self.client.calls, ['a', 'a'])
+
+
+class FakeResponse:
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.content = text.encode()
+        self.headers = headers or {}
+
+
+class ConditionalFileTest(unittest.TestCase):
+    def setUp(self):
+        self.parsed = []
+        self.file = exporter.ConditionalFile('https://example.invalid/contract.txt', self.parse)
+
+    def parse(self, text):
+        self.parsed.append(text)
+        return int(text)
+
+    def fetch(self, *responses):
+        with mock.patch.object(exporter.http, 'get', side_effect=responses) as get:
+            models = [self.file.fetch(1) for _ in responses]
+        return models, get
+
+    def test_unchanged_body_without_validators_is_not_parsed_again(self):
+        models, _ = self.fetch(FakeResponse(200, '10'), FakeResponse(200, '10'), FakeResponse(200, '20'))
+        self.assertEqual(models, [10, 10, 20])
+        self.assertEqual(self.parsed, ['10', '20'])
+
+    def test_not_modified_keeps_the_model(self):
+        models, get = self.fetch(FakeResponse(200, '10', {'ETag': '"a"'}), FakeResponse(304))
+        self.assertEqual(models, [10, 10])
+        self.assertEqual(get.call_args.kwargs['headers'], {'If-None-Match': '"a"'})
+        self.assertEqual(self.parsed, ['10'])
+
+    def test_failed_parse_keeps_the_previous_validators(self):
+        self.fetch(FakeResponse(200, '10', {'ETag': '"a"'}))
+        with self.assertRaises(ValueError):
+            self.fetch(FakeResponse(200, 'bad', {'ETag': '"b"'}))
+        self.assertEqual((self.file.model, self.file.etag), (10, '"a"'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,351 @@
 #!/usr/bin/env python3
 import os
 import time
+import asyncio
+import json
+import codecs
+import sqlite3
+import fcntl
+import gzip
+import hashlib
+import hmac
+import random
+import re
 import datetime
 import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
 import boto3
-from flask import Flask, Response
+from flask import Flask, Response, request
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
+try:
+    import wasabi_analytics  # requiere numpy
+except ImportError:
+    wasabi_analytics = None
+
 app = Flask(__name__)
-metrics_output = ""  # Se actualiza cada hora desde el thread
+
+# Con varios workers (gunicorn) solo uno recolecta y comparte el snapshot por este archivo
+SNAPSHOT_FILE = os.getenv("SNAPSHOT_FILE", "")
+COLLECTOR_LOCK = os.getenv("COLLECTOR_LOCK", "data/collector.lock")
+REFRESH_TRIGGER = os.getenv("REFRESH_TRIGGER", "data/refresh.trigger")  # /refresh desde otro worker
+
+REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL", "600"))  # segundos entre ciclos exitosos
+REFRESH_JITTER = float(os.getenv("REFRESH_JITTER", "0.1"))  # fracción aleatoria del intervalo
+RETRY_BASE = int(os.getenv("RETRY_BASE", "60"))  # primer reintento tras un error, luego se duplica
+RETRY_MAX = int(os.getenv("RETRY_MAX", "3600"))
+MAX_STALENESS = int(os.getenv("MAX_STALENESS", "7200"))  # segundos que se sirve el último dato bueno
+# Los contratos no caducan: su último modelo parseado se sigue publicando aunque fallen las descargas
+NO_STALENESS_SOURCES = ('contract', 'contract_csv')
+REFRESH_TOKEN = os.getenv("REFRESH_TOKEN", "")  # sin token /refresh queda deshabilitado
+REFRESH_MIN_INTERVAL = int(os.getenv("REFRESH_MIN_INTERVAL", "60"))
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "")  # JSON [{"name", "access_key", "secret_key"}] para varias cuentas
+COLLECTOR_THREADS = int(os.getenv("COLLECTOR_THREADS", "32"))
+
+class MetricsSnapshot:
+    """
+    Exposición ya renderizada e inmutable: cuerpo, cuerpo gzip, ETag y hora de generación.
+    El thread de recolección publica una nueva instancia y /metrics solo la lee.
+    """
+    __slots__ = ('body', 'gzip_body', 'etag', 'generated_at', 'series')
+
+    def __init__(self, text, generated_at=None):
+        self.body = text.encode('utf-8')
+        self.series = sum(1 for line in text.splitlines() if line and not line.startswith('#'))
+        self.gzip_body = gzip.compress(self.body, compresslevel=6)
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.generated_at = generated_at or datetime.datetime.now(datetime.timezone.utc)
+
+metrics_snapshot = MetricsSnapshot("")  # Se reemplaza completo desde el thread
+collector_leader = False  # True en el proceso que tiene COLLECTOR_LOCK
+snapshot_checked = 0.0
+snapshot_mtime = None
+
+def publish_metrics(text):
+    """
+    Renderiza el snapshot fuera de las requests y lo publica con una sola asignación.
+    Con SNAPSHOT_FILE también lo deja en disco (reemplazo atómico) para los demás workers.
+    """
+    global metrics_snapshot
+    snapshot = MetricsSnapshot(text)
+    if SNAPSHOT_FILE:
+        tmp = f"{SNAPSHOT_FILE}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(snapshot.body)
+        os.replace(tmp, SNAPSHOT_FILE)
+    metrics_snapshot = snapshot
+
+def current_snapshot():
+    """
+    En los workers que no recolectan, recarga SNAPSHOT_FILE cuando cambia (como máximo
+    un stat por segundo); el snapshot y su gzip se arman una vez por generación.
+    """
+    global metrics_snapshot, snapshot_checked, snapshot_mtime
+    if not SNAPSHOT_FILE or collector_leader:
+        return metrics_snapshot
+    now = time.monotonic()
+    if now - snapshot_checked >= 1:
+        snapshot_checked = now
+        try:
+            st = os.stat(SNAPSHOT_FILE)
+            if st.st_mtime_ns != snapshot_mtime:
+                with open(SNAPSHOT_FILE, 'rb') as f:
+                    text = f.read().decode('utf-8')
+                generated_at = datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc)
+                metrics_snapshot = MetricsSnapshot(text, generated_at)
+                snapshot_mtime = st.st_mtime_ns
+        except OSError:
+            pass
+    return metrics_snapshot
+
+PHASE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+SCRAPE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+class Histogram:
+    """
+    Histograma acumulativo con buckets fijos (_bucket, _sum y _count como en Prometheus).
+    """
+    __slots__ = ('bounds', 'counts', 'total', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+    def lines(self, name, labels=''):
+        sep = ',' if labels else ''
+        out = [f'{name}_bucket{{{labels}{sep}le="{bound}"}} {n}' for bound, n in zip(self.bounds, self.counts)]
+        out.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        labels = f'{{{labels}}}' if labels else ''
+        out.append(f'{name}_sum{labels} {self.total:.6f}')
+        out.append(f'{name}_count{labels} {self.count}')
+        return out
+
+class Instrumentation:
+    """
+    Métricas internas del exporter. Las de recolección van dentro del snapshot (las
+    mide el worker que recolecta); las de scrape las agrega cada worker a su respuesta.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}  # (cuenta, fase) -> Histogram
+        self.last_success = {}  # (cuenta, fuente) -> timestamp unix
+        self.refresh_lag = {}  # colección -> segundos
+        self.scrapes = Histogram(SCRAPE_BUCKETS)
+
+    def observe_cycle(self, durations, errors, account=''):
+        now = time.time()
+        with self.lock:
+            for phase, seconds in durations.items():
+                key = (account, phase)
+                if key not in self.phases:
+                    self.phases[key] = Histogram(PHASE_BUCKETS)
+                self.phases[key].observe(seconds)
+                if phase not in errors:
+                    self.last_success[key] = now
+
+    def observe_lag(self, collection, seconds):
+        with self.lock:
+            self.refresh_lag[collection] = seconds
+
+    def observe_scrape(self, seconds):
+        with self.lock:
+            self.scrapes.observe(seconds)
+
+    def collection_lines(self):
+        with self.lock:
+            lines = [
+                '# HELP wasabi_exporter_phase_duration_seconds Duration of each collection phase',
+                '# TYPE wasabi_exporter_phase_duration_seconds histogram',
+            ]
+            for account, phase in sorted(self.phases):
+                labels = f'{account_label(account)}phase="{phase}"'
+                lines.extend(self.phases[account, phase].lines('wasabi_exporter_phase_duration_seconds', labels))
+            lines.append('# HELP wasabi_exporter_last_success_timestamp_seconds Last time each source was collected successfully')
+            lines.append('# TYPE wasabi_exporter_last_success_timestamp_seconds gauge')
+            for account, source in sorted(self.last_success):
+                labels = f'{account_label(account)}source="{source}"'
+                lines.append(f'wasabi_exporter_last_success_timestamp_seconds{{{labels}}} {self.last_success[account, source]:.3f}')
+            lines.append('# HELP wasabi_exporter_refresh_lag_seconds How late the last refresh cycle started compared to its schedule')
+            lines.append('# TYPE wasabi_exporter_refresh_lag_seconds gauge')
+            for collection in sorted(self.refresh_lag):
+                lines.append(f'wasabi_exporter_refresh_lag_seconds{{collection="{collection}"}} {self.refresh_lag[collection]:.6f}')
+            return lines
+
+    def scrape_lines(self, snapshot):
+        """
+        Parte que cambia en cada request; se agrega al final del snapshot.
+        """
+        age = (datetime.datetime.now(datetime.timezone.utc) - snapshot.generated_at).total_seconds()
+        worker = f'worker="{os.getpid()}"'
+        with self.lock:
+            lines = [
+                '# HELP wasabi_exporter_scrape_duration_seconds Time spent answering /metrics',
+                '# TYPE wasabi_exporter_scrape_duration_seconds histogram',
+            ]
+            lines.extend(self.scrapes.lines('wasabi_exporter_scrape_duration_seconds', worker))
+        lines.extend([
+            '# HELP wasabi_exporter_snapshot_age_seconds Age of the published snapshot',
+            '# TYPE wasabi_exporter_snapshot_age_seconds gauge',
+            f'wasabi_exporter_snapshot_age_seconds {age:.3f}',
+            '# HELP wasabi_exporter_series Samples in the published snapshot',
+            '# TYPE wasabi_exporter_series gauge',
+            f'wasabi_exporter_series {snapshot.series}',
+            '# HELP wasabi_exporter_payload_bytes Size of the published snapshot',
+            '# TYPE wasabi_exporter_payload_bytes gauge',
+            f'wasabi_exporter_payload_bytes{{encoding="identity"}} {len(snapshot.body)}',
+            f'wasabi_exporter_payload_bytes{{encoding="gzip"}} {len(snapshot.gzip_body)}',
+        ])
+        return "\n".join(lines) + "\n"
+
+instrumentation = Instrumentation()
+
+def escape_label_value(value):
+    """
+    Escapa \\, " y saltos de línea como pide el formato de exposición.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def account_label(account):
+    """
+    Con una sola cuenta (sin ACCOUNTS_FILE) las series no llevan la etiqueta account.
+    """
+    return f'account="{escape_label_value(account)}",' if account else ''
+
+def account_pairs(account):
+    return (('account', account),) if account else ()
+
+INVALID_LABEL_CHARS = re.compile(r'[^a-zA-Z0-9_]')
+BUCKET_LABELS = ('account', 'bucket', 'untagged')  # etiquetas propias de las series por bucket
+
+def label_name(key):
+    """
+    Nombre de etiqueta válido a partir de la clave de un tag: los caracteres no permitidos
+    pasan a '_' y se antepone 'tag_' si empieza con dígito, con '__' (reservado) o choca
+    con una etiqueta del exporter.
+    """
+    name = INVALID_LABEL_CHARS.sub('_', key)
+    if not name or name[0].isdigit() or name.startswith('__') or name in BUCKET_LABELS:
+        name = 'tag_' + name
+    return name
+
+class LabelSets:
+    """
+    Conjuntos de etiquetas internados: cada combinación se renderiza una sola vez
+    ('{a="x",b="y"}') y todas las series que la usan comparten el mismo string. Una
+    instancia por render que reutiliza los de la anterior, así solo se conservan los
+    conjuntos que siguen publicándose.
+    """
+    __slots__ = ('sets', 'tags', 'previous_sets', 'previous_tags')
+
+    def __init__(self, previous=None):
+        self.sets = {}  # tupla de pares (nombre, valor) -> string renderizado
+        self.tags = {}  # tags ordenados del bucket -> pares exportados
+        self.previous_sets = previous.sets if previous else {}
+        self.previous_tags = previous.tags if previous else {}
+
+    def get(self, pairs):
+        rendered = self.sets.get(pairs)
+        if rendered is None:
+            if pairs in self.previous_sets:
+                rendered = self.previous_sets[pairs]
+            elif pairs:
+                rendered = '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + '}'
+            else:
+                rendered = ''
+            self.sets[pairs] = rendered
+        return rendered
+
+    def tag_pairs(self, tags):
+        """
+        :param tags: dict de tags del bucket.
+        :return: pares (nombre, valor) de los tags en TAG_LABELS con nombres saneados; si
+                 dos claves dan el mismo nombre queda la primera en orden alfabético.
+        """
+        key = tuple(sorted(tags.items()))
+        pairs = self.tags.get(key)
+        if pairs is None:
+            if key in self.previous_tags:
+                pairs = self.previous_tags[key]
+            else:
+                seen = set()
+                pairs = []
+                for k, v in key:
+                    if TAG_LABEL_KEYS is not None and k not in TAG_LABEL_KEYS:
+                        continue
+                    name = label_name(k)
+                    if name not in seen:
+                        seen.add(name)
+                        pairs.append((name, v))
+                pairs = tuple(pairs)
+            self.tags[key] = pairs
+        return pairs
+
+class MetricFamily:
+    """
+    Series de una métrica: sus conjuntos de etiquetas (strings de LabelSets) y los
+    valores en un array compacto en vez de una línea formateada por muestra.
+    """
+    __slots__ = ('name', 'help', 'labels', 'values', 'precision')
+
+    def __init__(self, name, help, precision=None, labels=None):
+        """
+        :param precision: decimales al renderizar; None para enteros.
+        :param labels: lista de conjuntos compartida con otras métricas de las mismas series
+                       (se agregan los valores directo a values).
+        """
+        self.name = name
+        self.help = help
+        self.labels = [] if labels is None else labels
+        self.values = array('q' if precision is None else 'd')
+        self.precision = precision
+
+    def add(self, labels, value):
+        self.labels.append(labels)
+        self.values.append(value)
+
+    def lines(self):
+        name = self.name
+        out = [f'# HELP {name} {self.help}', f'# TYPE {name} gauge']
+        if self.precision is None:
+            out.extend(f'{name}{labels} {value}' for labels, value in zip(self.labels, self.values))
+        else:
+            spec = f'.{self.precision}f'
+            out.extend(f'{name}{labels} {value:{spec}}' for labels, value in zip(self.labels, self.values))
+        return out
+
+TAG_CACHE_TTL = int(os.getenv("TAG_CACHE_TTL", "86400"))  # segundos
+TAG_CACHE_SIZE = int(os.getenv("TAG_CACHE_SIZE", "10000"))
+TAG_FETCH_WORKERS = int(os.getenv("TAG_FETCH_WORKERS", "16"))
+# Claves de tag exportadas como etiquetas, separadas por comas. Por defecto ninguna: cada
+# clave/valor distinto crea series nuevas, "*" (todas) hay que pedirlo explícitamente
+TAG_LABELS = os.getenv("TAG_LABELS", "")
+TAG_LABEL_KEYS = None if TAG_LABELS.strip() == "*" else {k.strip() for k in TAG_LABELS.split(",") if k.strip()}
+BILLING_DB = os.getenv("BILLING_DB", "data/wasabi_billing.db")
+BILLING_TIMEOUT = int(os.getenv("BILLING_TIMEOUT", "300"))  # segundos por fuente
+CONTRACT_TIMEOUT = int(os.getenv("CONTRACT_TIMEOUT", "30"))
+TAGS_TIMEOUT = int(os.getenv("TAGS_TIMEOUT", "300"))
+ANALYTICS_WINDOW = int(os.getenv("ANALYTICS_WINDOW", "90"))  # días de histórico analizados
+FORECAST_HORIZON = int(os.getenv("FORECAST_HORIZON", "30"))  # días a futuro
+ANALYTICS_TIMEOUT = int(os.getenv("ANALYTICS_TIMEOUT", "60"))
+ANALYTICS_CUSTOMER_TAG = os.getenv("ANALYTICS_CUSTOMER_TAG", "customer")  # tag bucket -> cliente del CSV
+
+BILLING_URL = "https://billing.wasabisys.com/utilization/bucket/?withname=true"
+CONTRACT_URL = "https://velocityshare.s3.wasabisys.com/internal/wasabi_contract.txt"
+CONTRACT_CSV_URL = "https://velocityshare.s3.wasabisys.com/internal/wasabi_contract_customers.csv"
 
 def get_bucket_tags(s3_client, bucket_name):
     try:
@@ -19,182 +355,952 @@ def get_bucket_tags(s3_client, bucket_name):
     except ClientError as e:
         return {}  # bucket sin tags o acceso denegado
 
-def fetch_metrics():
-    global metrics_output
-    while True:
+class TagCache:
+    """
+    Cache en memoria de tags por bucket, con TTL y expulsión LRU.
+    """
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # bucket -> (expira, tags)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.fetch_seconds = 0.0
 
+    def get(self, bucket):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(bucket)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(bucket)
+            self.hits += 1
+            return entry[1]
 
-        access_key = os.getenv("WASABI_ACCESS_KEY")
-        secret_key = os.getenv("WASABI_SECRET_KEY")
+    def put(self, bucket, tags):
+        with self.lock:
+            self.entries[bucket] = (time.monotonic() + self.ttl, tags)
+            self.entries.move_to_end(bucket)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
 
-        if not access_key or not secret_key:
-            metrics_output = "# ERROR: Missing WASABI_ACCESS_KEY or WASABI_SECRET_KEY\n"
-            time.sleep(3600)
-            continue
+    def record_fetch(self, seconds):
+        with self.lock:
+            self.fetches += 1
+            self.fetch_seconds += seconds
+
+    def metrics_lines(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            ratio = self.hits / lookups if lookups else 0
+            return [
+                '# HELP wasabi_exporter_tag_cache_hits_total Bucket tag lookups served from cache',
+                '# TYPE wasabi_exporter_tag_cache_hits_total counter',
+                f'wasabi_exporter_tag_cache_hits_total {self.hits}',
+                '# HELP wasabi_exporter_tag_cache_misses_total Bucket tag lookups that required a fetch',
+                '# TYPE wasabi_exporter_tag_cache_misses_total counter',
+                f'wasabi_exporter_tag_cache_misses_total {self.misses}',
+                '# HELP wasabi_exporter_tag_cache_hit_ratio Ratio of bucket tag lookups served from cache',
+                '# TYPE wasabi_exporter_tag_cache_hit_ratio gauge',
+                f'wasabi_exporter_tag_cache_hit_ratio {ratio:.4f}',
+                '# HELP wasabi_exporter_tag_cache_entries Buckets currently held in the tag cache',
+                '# TYPE wasabi_exporter_tag_cache_entries gauge',
+                f'wasabi_exporter_tag_cache_entries {len(self.entries)}',
+                '# HELP wasabi_exporter_tag_fetch_seconds Latency of get_bucket_tagging calls',
+                '# TYPE wasabi_exporter_tag_fetch_seconds summary',
+                f'wasabi_exporter_tag_fetch_seconds_sum {self.fetch_seconds:.6f}',
+                f'wasabi_exporter_tag_fetch_seconds_count {self.fetches}',
+            ]
 
-        # Cliente boto3 para Wasabi
-        session = boto3.session.Session(
-            aws_access_key_id=access_key,
-            aws_secret_access_key=secret_key,
-            region_name='us-east-1'
-        )
-        s3_client = session.client('s3', endpoint_url='https://s3.wasabisys.com')
+tag_cache = TagCache(TAG_CACHE_TTL, TAG_CACHE_SIZE)
 
+def fetch_bucket_tags(s3_client, buckets):
+    """
+    Devuelve bucket -> tags. Solo consulta a Wasabi los buckets que no están en
+    cache o cuya entrada expiró, en paralelo con un pool acotado de threads.
+    """
+    result = {}
+    pending = []
+    for b in buckets:
+        tags = tag_cache.get(b)
+        if tags is None:
+            pending.append(b)
+        else:
+            result[b] = tags
+
+    def fetch(b):
+        start = time.monotonic()
         try:
-            response = requests.get(
-                "https://billing.wasabisys.com/utilization/bucket/?withname=true",
-                headers={"Authorization": f'{access_key}:{secret_key}'}
-            )
-            json_data = response.json()
+            tags = get_bucket_tags(s3_client, b)
         except Exception as e:
-            metrics_output = f"# ERROR: Failed to fetch Wasabi data: {str(e)}\n"
-            time.sleep(3600)
+            print(f"[{datetime.datetime.now()}] Error fetching tags for {b}: {e}")
+            return b, None
+        finally:
+            tag_cache.record_fetch(time.monotonic() - start)
+        tag_cache.put(b, tags)
+        return b, tags
+
+    if pending:
+        with ThreadPoolExecutor(max_workers=TAG_FETCH_WORKERS) as pool:
+            for b, tags in pool.map(fetch, pending):
+                result[b] = tags or {}
+    return result
+
+BILLING_CHUNK_SIZE = 64 * 1024
+
+# iter_json_array y aggregate_billing son copia de las de linbrenms/wasabi_billing.py (la
+# imagen se construye solo con wasabi/): cualquier cambio hay que hacerlo en las dos.
+
+def iter_json_array(chunks):
+    """
+    Parsea incrementalmente un array JSON y entrega sus elementos uno a uno,
+    así el payload completo de facturación nunca queda en memoria.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    started = False
+    eof = False
+
+    while True:
+        # Saltar espacios y separadores entre elementos
+        while pos < len(buf) and buf[pos] in ' \t\r\n,[':
+            if buf[pos] == '[':
+                if started:
+                    break
+                started = True
+            pos += 1
+        if pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf) and not started:
+            raise ValueError('Billing payload is not a JSON array')
+
+        if pos < len(buf):
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            else:
+                # Un escalar que termina justo en el borde del buffer puede venir cortado
+                if end < len(buf) or eof or isinstance(item, (dict, list)):
+                    yield item
+                    pos = end
+                    continue
+
+        if eof:
+            raise ValueError('Billing payload ended before the closing bracket')
+        chunk = next(chunks, None)
+        if chunk is None:
+            buf = buf[pos:] + utf8.decode(b'', final=True)
+            eof = True
+        else:
+            buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
+
+BILLING_FIELDS = (
+    'PaddedStorageSizeBytes',
+    'DeletedStorageSizeBytes',
+    'NumBillableObjects',
+    'NumBillableDeletedObjects'
+)
+
+def aggregate_billing(json_data):
+    """
+    Recorre las filas de facturación una sola vez y las suma por (bucket, día).
+    StartTime viene como '%Y-%m-%dT%H:%M:%SZ', el día son los primeros 10 caracteres.
+    Devuelve (StartTime de la primera fila, dict (bucket, 'YYYY-MM-DD') -> contadores).
+    """
+    index = {}
+    first_start = None
+    for row in json_data:
+        start = row['StartTime']
+        if first_start is None:
+            first_start = start
+        key = (row['Bucket'], start[:10])
+        result = index.get(key)
+        if result is None:
+            result = index[key] = dict.fromkeys(BILLING_FIELDS, 0)
+        for field in BILLING_FIELDS:
+            result[field] += row[field]
+    return first_start, index
+
+def open_billing_store(path):
+    """
+    Abre (o crea) la base SQLite local con la utilización diaria por bucket.
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)  # se usa desde el executor
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS bucket_usage ("
+        " bucket TEXT NOT NULL,"
+        " day TEXT NOT NULL,"
+        " padded_storage_bytes INTEGER NOT NULL,"
+        " deleted_storage_bytes INTEGER NOT NULL,"
+        " billable_objects INTEGER NOT NULL,"
+        " billable_deleted_objects INTEGER NOT NULL,"
+        " PRIMARY KEY (bucket, day))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS bucket_usage_day ON bucket_usage (day)")
+    conn.commit()
+    return conn
+
+def latest_billing_day(conn):
+    return conn.execute("SELECT MAX(day) FROM bucket_usage").fetchone()[0]
+
+def store_billing(conn, index, since):
+    """
+    Guarda los días >= since (todos si since es None). El día since se reemplaza
+    porque en la sincronización anterior pudo venir incompleto.
+    """
+    rows = [
+        (b, day) + tuple(result[field] for field in BILLING_FIELDS)
+        for (b, day), result in index.items()
+        if since is None or day >= since
+    ]
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO bucket_usage VALUES (?, ?, ?, ?, ?, ?)", rows)
+    return len(rows)
+
+def billing_day_usage(conn, day):
+    """
+    Devuelve bucket -> contadores para un día ya almacenado.
+    """
+    cursor = conn.execute(
+        "SELECT bucket, padded_storage_bytes, deleted_storage_bytes, billable_objects,"
+        " billable_deleted_objects FROM bucket_usage WHERE day = ?",
+        (day,)
+    )
+    return {row[0]: dict(zip(BILLING_FIELDS, row[1:])) for row in cursor}
+
+# Pools compartidos por todas las cuentas: conexiones HTTP a la API de facturación y
+# threads donde corren las llamadas bloqueantes de cada ciclo
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_maxsize=COLLECTOR_THREADS))
+collector_pool = ThreadPoolExecutor(max_workers=COLLECTOR_THREADS, thread_name_prefix="collector")
+
+class Account:
+    """
+    Una cuenta Wasabi: credenciales, store de facturación y cliente S3 (se reusa entre ciclos).
+    """
+    def __init__(self, name, access_key, secret_key, db_path):
+        self.name = name
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.store = open_billing_store(db_path)
+        self.billing_lock = threading.Lock()
+        self.s3_client = None
+        self.history = None  # wasabi_analytics.BucketHistory, se actualiza por días nuevos
+
+    def client(self):
+        if self.s3_client is None:
+            # Cliente boto3 para Wasabi
+            session = boto3.session.Session(
+                aws_access_key_id=self.access_key,
+                aws_secret_access_key=self.secret_key,
+                region_name='us-east-1'
+            )
+            self.s3_client = session.client(
+                's3',
+                endpoint_url='https://s3.wasabisys.com',
+                config=Config(max_pool_connections=TAG_FETCH_WORKERS)
+            )
+        return self.s3_client
+
+def load_accounts():
+    """
+    Sin ACCOUNTS_FILE hay una sola cuenta (WASABI_ACCESS_KEY / WASABI_SECRET_KEY, sin
+    etiqueta account). Con ACCOUNTS_FILE cada cuenta usa su propio BILLING_DB-<nombre>;
+    'contracts' está reservado para la colección de los contratos y el nombre no puede
+    llevar '/' (es parte de la ruta del store).
+    """
+    if not ACCOUNTS_FILE:
+        return [Account("", os.getenv("WASABI_ACCESS_KEY"), os.getenv("WASABI_SECRET_KEY"), BILLING_DB)]
+
+    with open(ACCOUNTS_FILE) as f:
+        entries = json.load(f)
+    root, ext = os.path.splitext(BILLING_DB)
+    accounts = []
+    names = set()
+    for entry in entries:
+        name = entry.get("name", "")
+        if not name or name in names or name == "contracts" or any(c in name for c in '"\\/'):
+            raise ValueError(f"Invalid or duplicated account name in {ACCOUNTS_FILE}: {name!r}")
+        names.add(name)
+        accounts.append(Account(name, entry.get("access_key"), entry.get("secret_key"), f"{root}-{name}{ext}"))
+    return accounts
+
+def collect_billing(account):
+    """
+    Sincroniza la facturación en el store y devuelve bucket -> contadores del último
+    día (None para los buckets del payload sin datos ese día).
+    """
+    if not account.access_key or not account.secret_key:
+        raise ValueError("Missing WASABI_ACCESS_KEY or WASABI_SECRET_KEY")
+    # Si una recolección anterior expiró su thread puede seguir usando el store
+    if not account.billing_lock.acquire(blocking=False):
+        raise RuntimeError("previous billing fetch still running")
+    try:
+        store = account.store
+        # Solo se piden los días desde el último ya almacenado (incluido, pudo estar incompleto)
+        since = latest_billing_day(store)
+        billing_url = BILLING_URL
+        if since:
+            billing_url += f"&from={since}"
+
+        # Con stream=True la conexión vuelve al pool (o se cierra si el parseo falla) al salir del with
+        with http.get(
+            billing_url,
+            headers={"Authorization": f'{account.access_key}:{account.secret_key}'},
+            stream=True,
+            timeout=BILLING_TIMEOUT
+        ) as response:
+            # Las filas se agregan a medida que se parsean, sin cargar el JSON completo
+            _, index = aggregate_billing(iter_json_array(response.iter_content(BILLING_CHUNK_SIZE)))
+        store_billing(store, index, since)
+
+        initial_day = latest_billing_day(store)
+        if initial_day is None:
+            raise ValueError("Invalid JSON structure or StartTime missing: no billing rows stored")
+
+        # Solo interesa el último día; los buckets del payload sin datos ese día van en cero
+        totals = billing_day_usage(store, initial_day)
+        for b, day in index:
+            totals.setdefault(b, None)
+        return totals
+    finally:
+        account.billing_lock.release()
+
+class ConditionalFile:
+    """
+    Descarga condicional (If-None-Match / If-Modified-Since) de un archivo que cambia poco.
+    Guarda el modelo ya parseado, así solo se parsea cuando el contenido cambió, y lo
+    conserva como último valor válido si una descarga falla. Un 200 con el mismo contenido
+    (servidor sin ETag ni Last-Modified) se detecta por el hash del cuerpo.
+    """
+    def __init__(self, url, parse):
+        self.url = url
+        self.parse = parse
+        self.etag = None
+        self.last_modified = None
+        self.digest = None  # sha256 del último cuerpo parseado
+        self.model = None
+        self.lock = threading.Lock()
+
+    def fetch(self, timeout):
+        with self.lock:
+            headers = {}
+            if self.model is not None:
+                if self.etag:
+                    headers["If-None-Match"] = self.etag
+                if self.last_modified:
+                    headers["If-Modified-Since"] = self.last_modified
+
+            response = http.get(self.url, headers=headers, timeout=timeout)
+            if response.status_code == 304:
+                return self.model
+            if response.status_code != 200:
+                raise RuntimeError(f"status {response.status_code}")
+
+            digest = hashlib.sha256(response.content).digest()
+            if self.model is None or digest != self.digest:
+                self.model = self.parse(response.text)
+                self.digest = digest
+            self.etag = response.headers.get("ETag")
+            self.last_modified = response.headers.get("Last-Modified")
+            return self.model
+
+def parse_contract(text):
+    return int(text.strip())
+
+def render_contract(contracted_bytes):
+    family = MetricFamily('wasabi_total_contracted_bytes', 'Total Wasabi storage contracted in bytes')
+    family.add('', contracted_bytes)
+    return family.lines()
+
+def parse_contract_csv(text):
+    """
+    :return: lista de contratos por cliente; las filas inválidas quedan como {'error': fila}.
+    """
+    contracts = []
+    csv_lines = text.strip().splitlines()
+    for row in csv_lines[1:]:  # Saltar encabezado
+        parts = row.strip().split(",")
+        if len(parts) < 3:
             continue
 
+        customer = parts[0].strip()
+        site = parts[1].strip()
+        contract_tib = parts[2].strip()
+
         try:
-            initial_time = datetime.datetime.strptime(json_data[0]['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
-        except Exception as e:
-            metrics_output = f"# ERROR: Invalid JSON structure or StartTime missing: {str(e)}\n"
-            time.sleep(3600)
+            contract_bytes = int(contract_tib) * 1024**4
+        except ValueError:
+            contracts.append({'error': row})
             continue
 
-        buckets = list(set(bucket['Bucket'] for bucket in json_data))
+        contract = {
+            'customer': customer,
+            'site': site,
+            'bytes': contract_bytes,
+            'term': None,
+            'start_ts': None,
+            'end_dt': None,
+        }
+
+        # Verificar si hay campos adicionales para fechas y término
+        if len(parts) >= 5:
+            term_str = parts[3].strip()
+            start_str = parts[4].strip()
+            end_str = parts[5].strip() if len(parts) > 5 else ""
+
+            try:
+                contract['term'] = int(term_str)
+            except ValueError:
+                pass  # ignorar término inválido
+
+            try:
+                start_dt = datetime.datetime.strptime(start_str, "%m/%d/%y")
+                contract['start_ts'] = int(start_dt.timestamp())
+            except Exception:
+                pass  # No se pudo parsear
 
-        lines = []
-        lines.append('# HELP wasabi_active_storage_bytes Active storage in bytes per bucket')
-        lines.append('# TYPE wasabi_active_storage_bytes gauge')
-        lines.append('# HELP wasabi_deleted_storage_bytes Deleted storage in bytes per bucket')
-        lines.append('# TYPE wasabi_deleted_storage_bytes gauge')
-        lines.append('# HELP wasabi_billable_objects Number of billable objects per bucket')
-        lines.append('# TYPE wasabi_billable_objects gauge')
-        lines.append('# HELP wasabi_deleted_billable_objects Number of deleted billable objects per bucket')
-        lines.append('# TYPE wasabi_deleted_billable_objects gauge')
+            try:
+                contract['end_dt'] = datetime.datetime.strptime(end_str, "%m/%d/%y")
+            except Exception:
+                pass
 
+        contracts.append(contract)
+    return contracts
+
+def render_contract_csv(contracts, label_sets):
+    lines = []
+    contracted = MetricFamily('wasabi_customer_contracted_bytes', 'Contracted Wasabi storage per customer in bytes')
+    term = MetricFamily('wasabi_contract_term_months', 'Contract term length in months')
+    start = MetricFamily('wasabi_service_start_timestamp', 'Service start date as Unix timestamp')
+    end = MetricFamily('wasabi_service_end_timestamp', 'Service end date as Unix timestamp')
+    expires = MetricFamily('wasabi_days_until_contract_expires', 'Days remaining until contract expiration (can be negative)')
+
+    now = datetime.datetime.utcnow()
+    for contract in contracts:
+        if 'error' in contract:
+            lines.append(f"# ERROR: Invalid contract value in row: {contract['error']}")
+            continue
+
+        labels = label_sets.get((('customer', contract['customer']), ('site', contract['site'])))
+        contracted.add(labels, contract['bytes'])
+        if contract['term'] is not None:
+            term.add(labels, contract['term'])
+        if contract['start_ts'] is not None:
+            start.add(labels, contract['start_ts'])
+        end_dt = contract['end_dt']
+        if end_dt:
+            end.add(labels, int(end_dt.timestamp()))
+            # Los días restantes se recalculan en cada ciclo aunque el archivo no cambie
+            expires.add(labels, (end_dt - now).days)
+
+    for family in (contracted, term, start, end, expires):
+        lines.extend(family.lines())
+    return lines
+
+contract_file = ConditionalFile(CONTRACT_URL, parse_contract)
+contract_csv_file = ConditionalFile(CONTRACT_CSV_URL, parse_contract_csv)
+
+class Cycle:
+    """
+    Resultados, errores y duración por fuente de un ciclo. Cada fuente corre en
+    collector_pool con su timeout; una fuente que falla no descarta las demás.
+    """
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+        self.durations = {}
+
+    async def run(self, source, timeout, func, *args):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
         try:
-            contract_response = requests.get("https://velocityshare.s3.wasabisys.com/internal/wasabi_contract.txt")
-            if contract_response.status_code == 200:
-                contracted_bytes_str = contract_response.text.strip()
-                contracted_bytes = int(contracted_bytes_str)
-                lines.append('# HELP wasabi_total_contracted_bytes Total Wasabi storage contracted in bytes')
-                lines.append('# TYPE wasabi_total_contracted_bytes gauge')
-                lines.append(f'wasabi_total_contracted_bytes {contracted_bytes}')
-            else:
-                lines.append(f'# ERROR: Failed to fetch contracted value, status {contract_response.status_code}')
+            self.results[source] = await asyncio.wait_for(loop.run_in_executor(collector_pool, func, *args), timeout)
+        except asyncio.TimeoutError:
+            self.errors[source] = f"timeout after {timeout}s"
         except Exception as e:
-            lines.append(f'# ERROR: Exception while fetching contracted value: {str(e)}')
+            self.errors[source] = str(e)
+        finally:
+            self.durations[source] = time.monotonic() - start
 
-        try:
-            csv_response = requests.get("https://velocityshare.s3.wasabisys.com/internal/wasabi_contract_customers.csv")
-            if csv_response.status_code == 200:
-                lines.append('# HELP wasabi_customer_contracted_bytes Contracted Wasabi storage per customer in bytes')
-                lines.append('# TYPE wasabi_customer_contracted_bytes gauge')
-                lines.append('# HELP wasabi_contract_term_months Contract term length in months')
-                lines.append('# TYPE wasabi_contract_term_months gauge')
-                lines.append('# HELP wasabi_service_start_timestamp Service start date as Unix timestamp')
-                lines.append('# TYPE wasabi_service_start_timestamp gauge')
-                lines.append('# HELP wasabi_service_end_timestamp Service end date as Unix timestamp')
-                lines.append('# TYPE wasabi_service_end_timestamp gauge')
-                lines.append('# HELP wasabi_days_until_contract_expires Days remaining until contract expiration (can be negative)')
-                lines.append('# TYPE wasabi_days_until_contract_expires gauge')
-
-                csv_lines = csv_response.text.strip().splitlines()
-                for row in csv_lines[1:]:  # Saltar encabezado
-                    parts = row.strip().split(",")
-                    if len(parts) < 3:
-                        continue
+async def collect_account(account):
+    """
+    Facturación de la cuenta y luego, en paralelo, los tags de sus buckets y el
+    análisis del histórico (si numpy está instalado).
+    """
+    cycle = Cycle()
+    await cycle.run('billing', BILLING_TIMEOUT, collect_billing, account)
+    if 'billing' in cycle.results:
+        sources = [cycle.run('tags', TAGS_TIMEOUT, fetch_bucket_tags, account.client(), cycle.results['billing'])]
+        if wasabi_analytics:
+            sources.append(cycle.run('analytics', ANALYTICS_TIMEOUT, analyze_account, account))
+        await asyncio.gather(*sources)
+    return cycle
 
-                    customer = parts[0].strip()
-                    site = parts[1].strip()
-                    contract_tib = parts[2].strip()
+def analyze_account(account):
+    """
+    :return: bucket -> (actual, crecimiento/día, pendiente, pronóstico lineal, pronóstico semanal).
+    """
+    history = wasabi_analytics.load_history(account.store, ANALYTICS_WINDOW, account.history)
+    account.history = history
+    if history is None:
+        return {}
+    stats = wasabi_analytics.analyze(history, FORECAST_HORIZON)
+    columns = zip(stats['current'], stats['growth'], stats['slope'], stats['linear'], stats['seasonal'])
+    return dict(zip(history.buckets, columns))
 
-                    labels = f'customer="{customer}",site="{site}"'
+def render_analytics(accounts, contracts, label_sets):
+    """
+    Crecimiento y pronóstico por bucket; días hasta llenar el contrato por cliente (buckets
+    con el tag ANALYTICS_CUSTOMER_TAG) y para el total contratado.
+    """
+    growth_family = MetricFamily('wasabi_bucket_growth_bytes_per_day', 'Average daily growth of active storage over the last 7 days', 0)
+    forecast = MetricFamily('wasabi_bucket_forecast_bytes', f'Forecast active storage {FORECAST_HORIZON} days after the last billing day', 0)
+    customer_full = MetricFamily('wasabi_customer_days_until_contract_full', 'Days until the customer buckets reach the contracted storage at the current trend', 1)
+    total_full = MetricFamily('wasabi_days_until_contract_full', 'Days until total active storage reaches wasabi_total_contracted_bytes at the current trend', 1)
+    customers = {}  # cliente -> [actual, pendiente]
+    total = [0.0, 0.0]
+    for collection in accounts:
+        account = account_pairs(collection.account)
+        bucket_tags = collection.results.get('tags', {})
+        for b, (current, growth, slope, linear, seasonal) in collection.results.get('analytics', {}).items():
+            pairs = account + (('bucket', b),)
+            if growth == growth:  # descarta NaN
+                growth_family.add(label_sets.get(pairs), growth)
+            if linear == linear:
+                forecast.add(label_sets.get(pairs + (('method', 'linear'),)), linear)
+                forecast.add(label_sets.get(pairs + (('method', 'seasonal'),)), seasonal)
+            if current != current or slope != slope:
+                continue
+            total[0] += current
+            total[1] += slope
+            customer = (bucket_tags.get(b) or {}).get(ANALYTICS_CUSTOMER_TAG)
+            if customer:
+                acc = customers.setdefault(customer, [0.0, 0.0])
+                acc[0] += current
+                acc[1] += slope
 
-                    # Métrica de espacio contratado
-                    try:
-                        contract_bytes = int(contract_tib) * 1024**4
-                        lines.append(f'wasabi_customer_contracted_bytes{{{labels}}} {contract_bytes}')
-                    except ValueError:
-                        lines.append(f'# ERROR: Invalid contract value in row: {row}')
-                        continue
+    capacity = {}
+    for contract in contracts.results.get('contract_csv', []):
+        if 'error' not in contract:
+            capacity[contract['customer']] = capacity.get(contract['customer'], 0) + contract['bytes']
 
-                    # Verificar si hay campos adicionales para fechas y término
-                    term = 0
-                    start_ts = None
-                    end_ts = None
-
-                    if len(parts) >= 5:
-                        term_str = parts[3].strip()
-                        start_str = parts[4].strip()
-                        end_str = parts[5].strip() if len(parts) > 5 else ""
-
-                        try:
-                            term = int(term_str)
-                            lines.append(f'wasabi_contract_term_months{{{labels}}} {term}')
-                        except ValueError:
-                            pass  # ignorar término inválido
-
-                        try:
-                            start_dt = datetime.datetime.strptime(start_str, "%m/%d/%y")
-                            lines.append(f'wasabi_service_start_timestamp{{{labels}}} {int(start_dt.timestamp())}')
-                        except Exception:
-                            start_dt = None  # No se pudo parsear
-
-                        try:
-                            end_dt = datetime.datetime.strptime(end_str, "%m/%d/%y")
-                            lines.append(f'wasabi_service_end_timestamp{{{labels}}} {int(end_dt.timestamp())}')
-                        except Exception:
-                            end_dt = None
-
-                        if end_dt:
-                            now = datetime.datetime.utcnow()
-                            days_left = (end_dt - now).days
-                            lines.append(f'wasabi_days_until_contract_expires{{{labels}}} {days_left}')
+    for customer in sorted(customers):
+        if customer in capacity:
+            days = wasabi_analytics.days_until(*customers[customer], capacity[customer])
+            if days is not None:
+                customer_full.add(label_sets.get((('customer', customer),)), days)
 
-            else:
-                lines.append(f'# ERROR: Failed to fetch contract CSV, status {csv_response.status_code}')
-        except Exception as e:
-            lines.append(f'# ERROR: Exception while fetching contract CSV: {str(e)}')
-
-        for b in buckets:
-            result = {
-                'PaddedStorageSizeBytes': 0,
-                'DeletedStorageSizeBytes': 0,
-                'NumBillableObjects': 0,
-                'NumBillableDeletedObjects': 0
-            }
-
-            for bucket in json_data:
-                if bucket['Bucket'] == b:
-                    time_bucket = datetime.datetime.strptime(bucket['StartTime'], '%Y-%m-%dT%H:%M:%SZ')
-                    if time_bucket.date() == initial_time.date():
-                        result['PaddedStorageSizeBytes'] += bucket['PaddedStorageSizeBytes']
-                        result['DeletedStorageSizeBytes'] += bucket['DeletedStorageSizeBytes']
-                        result['NumBillableObjects'] += bucket['NumBillableObjects']
-                        result['NumBillableDeletedObjects'] += bucket['NumBillableDeletedObjects']
-
-            # Tags como etiquetas adicionales en Prometheus
-            tags = get_bucket_tags(s3_client, b)
+    if 'contract' in contracts.results:
+        days = wasabi_analytics.days_until(*total, contracts.results['contract'])
+        if days is not None:
+            total_full.add('', days)
+
+    lines = []
+    for family in (growth_family, forecast, customer_full, total_full):
+        lines.extend(family.lines())
+    return lines
+
+async def collect_contracts():
+    """
+    Archivos de contrato, compartidos por todas las cuentas, descargados en paralelo.
+    """
+    cycle = Cycle()
+    await asyncio.gather(
+        cycle.run('contract', CONTRACT_TIMEOUT, contract_file.fetch, CONTRACT_TIMEOUT),
+        cycle.run('contract_csv', CONTRACT_TIMEOUT, contract_csv_file.fetch, CONTRACT_TIMEOUT),
+    )
+    return cycle
+
+label_sets = LabelSets()  # conjuntos del último render, solo los usa publish_all
+
+def render_metrics(accounts, contracts):
+    """
+    :param accounts: colecciones de cada cuenta Wasabi.
+    :param contracts: colección de los archivos de contrato.
+    """
+    global label_sets
+    label_sets = LabelSets(label_sets)
+    lines = []
+    for collection in [contracts] + list(accounts):
+        if 'cycle' in collection.errors:
+            lines.append(f"# ERROR: {collection.error_prefix()}Collection cycle failed: {collection.errors['cycle']}")
+    for collection in accounts:
+        if 'billing' in collection.errors:
+            lines.append(f"# ERROR: {collection.error_prefix()}Failed to fetch Wasabi data: {collection.errors['billing']}")
+
+    results, errors = contracts.results, contracts.errors
+    if 'contract' in errors:
+        lines.append(f"# ERROR: Exception while fetching contracted value: {errors['contract']}")
+    if 'contract' in results:
+        lines.extend(render_contract(results['contract']))
+
+    if 'contract_csv' in errors:
+        lines.append(f"# ERROR: Exception while fetching contract CSV: {errors['contract_csv']}")
+    if 'contract_csv' in results:
+        lines.extend(render_contract_csv(results['contract_csv'], label_sets))
+
+    # Las cuatro métricas por bucket comparten la lista de conjuntos de etiquetas
+    bucket_labels = []
+    families = (
+        MetricFamily('wasabi_active_storage_bytes', 'Active storage in bytes per bucket', labels=bucket_labels),
+        MetricFamily('wasabi_deleted_storage_bytes', 'Deleted storage in bytes per bucket', labels=bucket_labels),
+        MetricFamily('wasabi_billable_objects', 'Number of billable objects per bucket', labels=bucket_labels),
+        MetricFamily('wasabi_deleted_billable_objects', 'Number of deleted billable objects per bucket', labels=bucket_labels),
+    )
+    active, deleted, objects, deleted_objects = (family.values for family in families)
+    empty = dict.fromkeys(BILLING_FIELDS, 0)
+
+    for collection in accounts:
+        results, errors = collection.results, collection.errors
+        if 'tags' in errors:
+            lines.append(f"# ERROR: {collection.error_prefix()}Failed to fetch bucket tags: {errors['tags']}")
+        bucket_tags = results.get('tags', {})
+        account = account_pairs(collection.account)
+
+        for b, result in results.get('billing', {}).items():
+            # Tags en TAG_LABELS como etiquetas adicionales en Prometheus
+            tags = bucket_tags.get(b)
             if not tags:
-                tags = {"untagged": "true"}  # Etiqueta por defecto si no tiene tags
+                tag_pairs = (('untagged', 'true'),) if TAG_LABEL_KEYS != set() else ()
+            else:
+                tag_pairs = label_sets.tag_pairs(tags)
+            bucket_labels.append(label_sets.get(account + (('bucket', b),) + tag_pairs))
+
+            result = result or empty
+            active.append(result['PaddedStorageSizeBytes'])
+            deleted.append(result['DeletedStorageSizeBytes'])
+            objects.append(result['NumBillableObjects'])
+            deleted_objects.append(result['NumBillableDeletedObjects'])
+
+    for family in families:
+        lines.extend(family.lines())
+
+    if wasabi_analytics:
+        lines.extend(render_analytics(accounts, contracts, label_sets))
 
-            tag_str = ",".join([f'{k}="{v}"' for k, v in tags.items()])
-            labels = f'bucket="{b}",{tag_str}'
+    lines.extend(tag_cache.metrics_lines())
+    lines.extend(instrumentation.collection_lines())
 
-            lines.append(f'wasabi_active_storage_bytes{{{labels}}} {result["PaddedStorageSizeBytes"]}')
-            lines.append(f'wasabi_deleted_storage_bytes{{{labels}}} {result["DeletedStorageSizeBytes"]}')
-            lines.append(f'wasabi_billable_objects{{{labels}}} {result["NumBillableObjects"]}')
-            lines.append(f'wasabi_deleted_billable_objects{{{labels}}} {result["NumBillableDeletedObjects"]}')
+    collections = [contracts] + list(accounts)
+    lines.append('# HELP wasabi_exporter_collection_duration_seconds Duration of the last collection per source')
+    lines.append('# TYPE wasabi_exporter_collection_duration_seconds gauge')
+    for collection in collections:
+        account = account_label(collection.account)
+        for source, seconds in sorted(collection.durations.items()):
+            lines.append(f'wasabi_exporter_collection_duration_seconds{{{account}source="{source}"}} {seconds:.6f}')
+    lines.append('# HELP wasabi_exporter_collection_success Whether the last collection of each source succeeded')
+    lines.append('# TYPE wasabi_exporter_collection_success gauge')
+    for collection in collections:
+        account = account_label(collection.account)
+        for source in sorted(collection.durations):
+            success = 0 if source in collection.errors else 1
+            lines.append(f'wasabi_exporter_collection_success{{{account}source="{source}"}} {success}')
 
-        metrics_output = "\n".join(lines) + "\n"
-        print(f"[{datetime.datetime.now()}] Metrics updated.")
-        time.sleep(600)
+    return "\n".join(lines) + "\n"
+
+class Scheduler:
+    """
+    Decide cuándo corre el próximo ciclo: intervalo con jitter (varias réplicas no
+    consultan la API al mismo tiempo), backoff exponencial con jitter tras errores y
+    ciclos a pedido desde /refresh. Los pedidos que llegan mientras hay un ciclo en
+    curso o antes de REFRESH_MIN_INTERVAL se unen al ciclo actual (singleflight).
+    """
+    def __init__(self):
+        self.wake = threading.Event()
+        self.lock = threading.Lock()
+        self.running = False
+        self.failures = 0
+        self.last_start = 0.0
+
+    def next_delay(self, failed):
+        if failed:
+            self.failures += 1
+            delay = min(RETRY_MAX, RETRY_BASE * 2 ** (self.failures - 1))
+        else:
+            self.failures = 0
+            delay = REFRESH_INTERVAL
+        return delay * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER)
+
+    def trigger(self):
+        """
+        :return: 'running' si se une a un ciclo en curso, 'fresh' si el último empezó hace
+                 menos de REFRESH_MIN_INTERVAL, 'scheduled' si se adelanta el próximo.
+        """
+        with self.lock:
+            if self.running:
+                return 'running'
+            if time.monotonic() - self.last_start < REFRESH_MIN_INTERVAL:
+                return 'fresh'
+            self.wake.set()
+            return 'scheduled'
+
+    def begin(self):
+        with self.lock:
+            self.running = True
+            self.last_start = time.monotonic()
+            self.wake.clear()
+
+    def end(self):
+        with self.lock:
+            self.running = False
+
+    def wait(self, delay):
+        """
+        Duerme hasta el próximo ciclo o hasta que trigger() lo adelante.
+        """
+        self.wake.wait(delay)
+
+class Collection:
+    """
+    Grupo de fuentes con su propio ciclo: una cuenta Wasabi o los archivos de contrato.
+    Cada una tiene su scheduler y sus últimos resultados buenos, así una cuenta lenta
+    o con errores no atrasa ni afecta a las demás.
+    """
+    def __init__(self, name, account, collect):
+        self.name = name
+        self.account = account
+        self.collect = collect
+        self.scheduler = Scheduler()
+        self.last_good = {}  # fuente -> (resultado, monotonic de cuando se obtuvo)
+        self.results = {}
+        self.errors = {}
+        self.durations = {}
+
+    def error_prefix(self):
+        return f'account="{self.account}": ' if self.account else ''
+
+    def run(self):
+        scheduled = time.monotonic()
+        while True:
+            self.scheduler.begin()
+            instrumentation.observe_lag(self.name, max(0.0, time.monotonic() - scheduled))
+            try:
+                cycle = asyncio.run(self.collect())
+                instrumentation.observe_cycle(cycle.durations, cycle.errors, self.account)
+
+                # Una fuente que falla (o no se pudo consultar) sigue publicando su último
+                # resultado bueno hasta MAX_STALENESS (sin límite las de NO_STALENESS_SOURCES);
+                # después desaparece
+                now = time.monotonic()
+                results = dict(cycle.results)
+                for source, result in results.items():
+                    self.last_good[source] = (result, now)
+                for source, (result, obtained) in self.last_good.items():
+                    if source not in results and (source in NO_STALENESS_SOURCES or now - obtained <= MAX_STALENESS):
+                        results[source] = result
+
+                # Se reemplazan juntos para que publish_all no mezcle ciclos
+                with publish_lock:
+                    self.results, self.errors, self.durations = results, cycle.errors, cycle.durations
+                publish_all()
+            except Exception as e:
+                # Un fallo fuera de las fuentes (p. ej. al escribir SNAPSHOT_FILE) no debe terminar
+                # el thread: queda en el # ERROR de la exposición y se reintenta con el backoff de error
+                with publish_lock:
+                    self.errors = {'cycle': f"{type(e).__name__}: {e}"}
+            finally:
+                self.scheduler.end()
+
+            delay = self.scheduler.next_delay(bool(self.errors))
+            if 'cycle' in self.errors:
+                print(f"[{datetime.datetime.now()}] Collection cycle failed ({self.name}): {self.errors['cycle']}, next in {delay:.0f}s")
+            elif self.errors:
+                print(f"[{datetime.datetime.now()}] Metrics updated ({self.name}) with errors: {self.errors}, next in {delay:.0f}s")
+            else:
+                print(f"[{datetime.datetime.now()}] Metrics updated ({self.name}).")
+            scheduled = time.monotonic() + delay
+            self.scheduler.wait(delay)
+
+collections = {}  # nombre -> Collection, solo en el proceso que recolecta
+publish_lock = threading.Lock()
+
+def publish_all():
+    """
+    Arma la exposición combinada con el último estado de todas las colecciones.
+    """
+    with publish_lock:
+        contracts = collections['contracts']
+        accounts = [c for c in collections.values() if c is not contracts]
+        start = time.monotonic()
+        publish_metrics(render_metrics(accounts, contracts))
+        instrumentation.observe_cycle({'render': time.monotonic() - start}, {})
+
+def collection_names():
+    """
+    :return: nombres de las colecciones configuradas ('contracts' y una por cuenta).
+    """
+    try:
+        accounts = load_accounts()
+    except (OSError, ValueError):
+        accounts = []
+    return {'contracts'} | {account.name or 'default' for account in accounts}
+
+def trigger_collections(name=''):
+    """
+    :param name: colección a adelantar (nombre de cuenta o 'contracts'); vacío para todas.
+    :return: dict nombre -> estado de Scheduler.trigger(), None si no existe.
+    """
+    if name:
+        if name not in collections:
+            return None
+        return {name: collections[name].scheduler.trigger()}
+    return {n: c.scheduler.trigger() for n, c in collections.items()}
+
+def read_trigger():
+    try:
+        with open(REFRESH_TRIGGER) as f:
+            return os.fstat(f.fileno()).st_mtime_ns, f.read().strip()
+    except OSError:
+        return None, ''
+
+def fetch_metrics():
+    """
+    Una colección (y un thread) por cuenta más una para los contratos. Este thread
+    queda atendiendo los /refresh que llegan a otros workers por REFRESH_TRIGGER.
+    """
+    while True:
+        try:
+            accounts = load_accounts()
+            break
+        except (OSError, ValueError) as e:
+            # Un ACCOUNTS_FILE inválido no debe terminar el thread: se publica el error
+            # y se vuelve a leer tras RETRY_BASE
+            print(f"[{datetime.datetime.now()}] Invalid account configuration: {e}")
+            publish_metrics(f"# ERROR: Invalid account configuration: {e}\n")
+            time.sleep(RETRY_BASE)
+
+    collections['contracts'] = Collection('contracts', '', collect_contracts)
+    for account in accounts:
+        name = account.name or 'default'
+        collections[name] = Collection(name, account.name, lambda account=account: collect_account(account))
+
+    for collection in collections.values():
+        thread = threading.Thread(target=collection.run, name=f"collect-{collection.name}")
+        thread.daemon = True
+        thread.start()
+
+    trigger_mtime, _ = read_trigger()
+    while True:
+        time.sleep(1)
+        if not SNAPSHOT_FILE:
+            continue
+        mtime, name = read_trigger()
+        if mtime != trigger_mtime:
+            trigger_mtime = mtime
+            trigger_collections(name)
+
+account_views = {}  # cuenta -> (ETag del snapshot combinado, vista filtrada)
+
+def account_view(snapshot, account):
+    """
+    /metrics?account=: solo las series con account="<cuenta>" (y sus HELP/TYPE). Se filtra
+    una vez por snapshot. :return: MetricsSnapshot o None si la cuenta no tiene series.
+    """
+    cached = account_views.get(account)
+    if cached and cached[0] == snapshot.etag:
+        return cached[1]
+    label = f'account="{escape_label_value(account)}"'
+    found = False
+    lines = []
+    for line in snapshot.body.decode('utf-8').splitlines():
+        if label in line:
+            found = True
+            lines.append(line)
+        elif line.startswith('# HELP') or line.startswith('# TYPE'):
+            lines.append(line)
+    if not found:
+        return None
+    view = MetricsSnapshot("\n".join(lines) + "\n", snapshot.generated_at)
+    account_views[account] = (snapshot.etag, view)
+    return view
 
 @app.route('/metrics')
 def metrics():
-    return Response(metrics_output, mimetype='text/plain')
+    start = time.perf_counter()
+    snapshot = current_snapshot()  # una sola lectura, el objeto no cambia
+    account = request.args.get('account')
+    if account:
+        snapshot = account_view(snapshot, account)
+        if snapshot is None:
+            return Response(f"unknown account {account}\n", status=404, mimetype='text/plain')
+    # El ETag es débil: identifica los datos recolectados, no las métricas de scrape del final
+    if request.if_none_match.contains_weak(snapshot.etag):
+        response = Response(status=304)
+    else:
+        tail = instrumentation.scrape_lines(snapshot).encode('utf-8')
+        if request.accept_encodings['gzip']:
+            # Un gzip puede tener varios miembros concatenados; solo se comprime la parte nueva
+            response = Response(snapshot.gzip_body + gzip.compress(tail, compresslevel=6), mimetype='text/plain')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(snapshot.body + tail, mimetype='text/plain')
+    response.set_etag(snapshot.etag, weak=True)
+    response.last_modified = snapshot.generated_at
+    response.vary.add('Accept-Encoding')
+    instrumentation.observe_scrape(time.perf_counter() - start)
+    return response
+
+@app.route('/refresh', methods=['POST'])
+def refresh():
+    """
+    Pide un ciclo de recolección inmediato, de todas las colecciones o de ?account=.
+    Requiere 'Authorization: Bearer <REFRESH_TOKEN>'.
+    """
+    if not REFRESH_TOKEN:
+        return Response("refresh disabled\n", status=404, mimetype='text/plain')
+    supplied = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(supplied.encode('utf-8'), f"Bearer {REFRESH_TOKEN}".encode('utf-8')):
+        return Response("unauthorized\n", status=401, mimetype='text/plain')
+
+    name = request.args.get('account', '')
+    if collector_leader or not SNAPSHOT_FILE:
+        status = trigger_collections(name)
+        if status is None:
+            return Response(f"unknown account {name}\n", status=404, mimetype='text/plain')
+    else:
+        # El ciclo corre en otro worker: se valida la cuenta aquí para que la respuesta
+        # no dependa del worker que atiende la request, y se le avisa por REFRESH_TRIGGER
+        if name and name not in collection_names():
+            return Response(f"unknown account {name}\n", status=404, mimetype='text/plain')
+        with open(REFRESH_TRIGGER, 'w') as f:
+            f.write(name)
+        status = {name or 'all': 'scheduled'}
+    return Response(json.dumps({"status": status}) + "\n", status=202, mimetype='application/json')
+
+def collector_election():
+    """
+    Solo el proceso que obtiene el lock recolecta. Si ese worker muere el lock se
+    libera y otro lo toma en el siguiente intento.
+    """
+    global collector_leader
+    directory = os.path.dirname(COLLECTOR_LOCK)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    lock_file = open(COLLECTOR_LOCK, 'w')
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            time.sleep(30)
+            continue
+        collector_leader = True
+        fetch_metrics()
 
 def start_background_thread():
-    thread = threading.Thread(target=fetch_metrics)
+    thread = threading.Thread(target=collector_election)
     thread.daemon = True
     thread.start()
 
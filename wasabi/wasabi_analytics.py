@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Análisis del histórico de facturación (tabla bucket_usage del BILLING_DB) con NumPy:
+crecimiento diario, pronóstico lineal y semanal por bucket, todo vectorizado sobre
+una matriz bucket x día.
+"""
+import datetime
+import numpy as np
+
+
+class BucketHistory:
+    """
+    Uso activo (padded_storage_bytes) de cada bucket por día, NaN donde no hay dato.
+    """
+    __slots__ = ('buckets', 'first_day', 'usage')
+
+    def __init__(self, buckets, first_day, usage):
+        self.buckets = buckets  # lista de nombres, una fila de usage por bucket
+        self.first_day = first_day  # datetime.date de la columna 0
+        self.usage = usage  # np.ndarray float64 (buckets, días)
+
+
+def load_history(conn, window, previous=None):
+    """
+    :param conn: conexión al BILLING_DB.
+    :param window: días hacia atrás desde el último día almacenado.
+    :param previous: BucketHistory de la llamada anterior; si se pasa solo se leen del
+                     store los días desde su último día (pudo estar incompleto) y el
+                     resto se desplaza en memoria.
+    :return: BucketHistory, o None si el store está vacío.
+    """
+    last = conn.execute("SELECT MAX(day) FROM bucket_usage").fetchone()[0]
+    if last is None:
+        return None
+    last_day = datetime.date.fromisoformat(last)
+    first_day = last_day - datetime.timedelta(days=window - 1)
+
+    since = first_day
+    buckets = []
+    usage = np.full((0, window), np.nan)
+    if previous is not None and previous.usage.shape[1] == window:
+        shift = (first_day - previous.first_day).days
+        if 0 <= shift < window:
+            buckets = list(previous.buckets)
+            usage = np.full((len(buckets), window), np.nan)
+            usage[:, :window - shift] = previous.usage[:, shift:]
+            since = previous.first_day + datetime.timedelta(days=window - 1)
+
+    # Una sola fila con las columnas concatenadas: SQLite arma los textos y NumPy los
+    # convierte sin crear una tupla de Python por fila (los nombres de bucket no llevan ',')
+    names, cols, values = conn.execute(
+        "SELECT group_concat(bucket), group_concat(CAST(julianday(day) - julianday(?1) AS INTEGER)),"
+        " group_concat(padded_storage_bytes) FROM bucket_usage WHERE day >= ?2",
+        (first_day.isoformat(), since.isoformat())
+    ).fetchone()
+    if names:
+        unique, inverse = np.unique(np.array(names.split(',')), return_inverse=True)
+        index = {name: i for i, name in enumerate(buckets)}
+        positions = np.array([index.setdefault(name, len(index)) for name in unique.tolist()], dtype=np.int64)
+        if len(index) > len(buckets):
+            buckets = list(index)
+            usage = np.vstack([usage, np.full((len(buckets) - usage.shape[0], window), np.nan)])
+        usage[positions[inverse], np.fromstring(cols, dtype=np.int64, sep=',')] = \
+            np.fromstring(values, dtype=np.float64, sep=',')
+
+    # Los buckets que ya no tienen datos en la ventana (borrados) no se arrastran
+    keep = ~np.isnan(usage).all(axis=1)
+    if not keep.all():
+        buckets = [name for name, kept in zip(buckets, keep) if kept]
+        usage = usage[keep]
+    return BucketHistory(buckets, first_day, usage)
+
+
+def analyze(history, horizon):
+    """
+    :param history: BucketHistory.
+    :param horizon: días a futuro del pronóstico, contados desde el último día.
+    :return: dict de arrays por bucket: current, growth (bytes/día, últimos 7 días),
+             slope (bytes/día, regresión lineal de toda la ventana), linear y seasonal
+             (uso pronosticado a horizon días). NaN donde no hay datos suficientes.
+    """
+    usage = history.usage
+    n_buckets, n_days = usage.shape
+    t = np.arange(n_days, dtype=np.float64)
+    mask = ~np.isnan(usage)
+    filled = np.where(mask, usage, 0.0)
+    count = mask.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Último valor conocido de cada bucket
+        last_idx = np.maximum.accumulate(np.where(mask, t.astype(np.int64), 0), axis=1)[:, -1]
+        current = np.where(count > 0, usage[np.arange(n_buckets), last_idx], np.nan)
+
+        # Crecimiento diario promedio de la última semana
+        diffs = np.diff(usage, axis=1)[:, -7:]
+        diff_mask = ~np.isnan(diffs)
+        growth = np.where(diff_mask, diffs, 0.0).sum(axis=1) / diff_mask.sum(axis=1)
+
+        # Mínimos cuadrados por fila ignorando los días sin dato
+        t_mean = (mask * t).sum(axis=1) / count
+        y_mean = filled.sum(axis=1) / count
+        dt = np.where(mask, t - t_mean[:, None], 0.0)
+        slope = (dt * (filled - y_mean[:, None])).sum(axis=1) / (dt * dt).sum(axis=1)
+        intercept = y_mean - slope * t_mean
+
+        target = n_days - 1 + horizon
+        linear = intercept + slope * target
+
+        # Estacionalidad semanal: residuo promedio de la regresión por día de la semana
+        seasonal = linear
+        if n_days >= 14:
+            weekday = (history.first_day.weekday() + np.arange(n_days)) % 7
+            onehot = (weekday[:, None] == np.arange(7)).astype(np.float64)
+            residual = np.where(mask, usage - (intercept[:, None] + slope[:, None] * t), 0.0)
+            profile = (residual @ onehot) / (mask.astype(np.float64) @ onehot)
+            target_weekday = (history.first_day.weekday() + target) % 7
+            seasonal = linear + np.nan_to_num(profile[:, target_weekday])
+
+    return {
+        'current': current,
+        'growth': growth,
+        'slope': slope,
+        'linear': linear,
+        'seasonal': seasonal,
+    }
+
+
+def days_until(current, slope, capacity):
+    """
+    Días hasta que current alcance capacity creciendo slope bytes/día.
+    :return: 0 si ya se alcanzó, None si no crece o faltan datos.
+    """
+    if not np.isfinite(current) or not np.isfinite(slope):
+        return None
+    if current >= capacity:
+        return 0.0
+    if slope <= 0:
+        return None
+    return float((capacity - current) / slope)